@@ -1,14 +1,24 @@
 import numpy as np
 import pandas as pd
 import pymc3 as pm, theano.tensor as tt
+import theano
+import scipy.optimize
+from pymc3.blocking import ArrayOrdering, DictToArrayBijection
+from pymc3.step_methods.hmc.quadpotential import QuadPotentialDiagAdapt
 import os
 import sys
 import math
-import pickle
+import json
+import hashlib
+import time
+import contextlib
 import argparse
-import subprocess
+import multiprocessing
 from collections import OrderedDict
 
+from genome_utils import get_sliding_windows, get_window_overlaps, parse_guide_coords, GUIDE_TARGETING, GUIDE_CONTROL
+from proc_utils import reset_peak_rss, peak_rss
+
 def get_args():    
     parser = argparse.ArgumentParser(description='Call peaks over CRISPRi screen windows.')
     parser.add_argument('input_data',help='Input flow-fish count data.')
@@ -19,6 +29,50 @@ def get_args():
     parser.add_argument('--step_size','-ss',type=int,default=100,help='Step size for peak calling.')
     parser.add_argument('--rope_threshold','-rt',default=0.693,type=float,help='ROPE threshold for peak calls.')
     parser.add_argument('--no_offsets','-no',action='store_true',help='Use exact coordinates for CRISPR activity. Use if Coordinates provided are exactly the region of effect.')
+    parser.add_argument('--draws',type=int,default=1000,help='Posterior draws per chain.')
+    parser.add_argument('--tune',type=int,default=4000,help='NUTS tuning steps per chain.')
+    parser.add_argument('--chains',type=int,default=8,help='NUTS chains per window.')
+    parser.add_argument('--cores',type=int,default=8,help='Processes used to run chains in parallel. Ignored (set to 1) with --workers > 1.')
+    parser.add_argument('--workers','-w',type=int,default=1,
+                        help='Local worker processes. Windows are preprocessed once and spread over a process pool, '+\
+                             'largest windows first, each worker running its chains on one core.')
+    parser.add_argument('--telemetry','-tm',type=str,default=None,
+                        help='JSON lines sidecar of stage wall times and per-window fit statistics, appended to. '+\
+                             'Off by default.')
+    parser.add_argument('--journal','-j',type=str,default=None,help='Per-window results journal, written as windows finish. Off by default.')
+    parser.add_argument('--resume','-r',action='store_true',help='Skip windows already recorded in --journal from an earlier run with the same settings.')
+    parser.add_argument('--random_seed','-rs',type=int,default=None,help='Random seed for downsampling and sampling. Recorded in the journal and reused on --resume.')
+    parser.add_argument('--slot_bucket','-sb',type=int,default=32,help='Pad window models to a multiple of this many guides so one compiled model serves many windows.')
+    parser.add_argument('--control_mode','-cm',type=str,default='joint',choices=['joint','samples','prior'],
+                        help='How control guides enter window models. joint: re-fit controls in every window. '+\
+                             'samples: fit controls once and pair their posterior draws with each window. '+\
+                             'prior: fit controls once and use a normal approximation of their posterior as a fixed prior.')
+    parser.add_argument('--likelihood','-lk',type=str,default='full',choices=['full','collapsed'],
+                        help='full: sample a guide_intensity for every guide. '+\
+                             'collapsed: integrate guide_intensity out and sample only enhancer_activity.')
+    parser.add_argument('--inference','-in',type=str,default='nuts',choices=['nuts','advi','laplace'],
+                        help='Posterior engine. advi and laplace are fast approximations; laplace is best paired with --likelihood collapsed.')
+    parser.add_argument('--advi_steps',type=int,default=20000,help='Optimization steps for --inference advi.')
+    parser.add_argument('--joint_windows','-jw',action='store_true',
+                        help='Fit every window in the chunk in one model with an enhancer_activity entry per window, so tuning is shared.')
+    parser.add_argument('--adaptive','-ad',action='store_true',
+                        help='Sample NUTS in batches and stop once R-hat, ESS and the HDR\'s distance from the ROPE '+\
+                             'bounds settle the call, up to --draws per chain.')
+    parser.add_argument('--adaptive_batch','-ab',type=int,default=200,help='Draws per chain in each --adaptive batch.')
+    parser.add_argument('--slim_trace','-st',action='store_true',
+                        help='Record only enhancer_activity in NUTS traces, plus the sampler\'s free variables when '+\
+                             'a run seeds a warm start or adaptive batch, instead of every per-guide deterministic.')
+    parser.add_argument('--warm_start',action='store_true',
+                        help='Start each NUTS run from the step size, mass matrix and chain positions reached on the '+\
+                             'previous window fit by the same model in the same process, tuning for only --warm_tune steps. '+\
+                             'With --workers 1 windows run in genomic order, so this is usually the neighbouring window. '+\
+                             'With --workers > 1 it is the previous window that worker fitted, as windows are dispatched '+\
+                             'largest first. Falls back to full --tune when the warm run diverges or mixes poorly.')
+    parser.add_argument('--warm_tune',type=int,default=500,help='Tuning steps for warm-started NUTS runs.')
+    parser.add_argument('--compare_windows',type=str,default=None,
+                        help='Comma separated window indices (e.g. 1,5,20) to also fit with the reference model '+\
+                             '(NUTS, full likelihood, joint controls) and compare against.')
+    parser.add_argument('--compare_report',type=str,default=None,help='TSV path for the comparison report. Defaults to stderr.')
     args = parser.parse_args()
     return args
 
@@ -28,6 +82,18 @@ def check_args(args):
     assert args.window_size > 0, "Windows must take up space."
     assert args.step_size > 0, "Step size must cause window to slide. (E.g. step_size > 0)."
     assert args.step_size <= args.window_size, "Can't have step_size > window_size. Will cause gaps."
+    assert args.slot_bucket > 0, "Slot bucket must hold at least one guide."
+    assert args.advi_steps > 0, "ADVI needs at least one optimization step."
+    assert args.draws > 0, "Need at least one posterior draw."
+    assert args.tune >= 0, "Tuning steps can't be negative."
+    assert args.chains > 0, "Need at least one chain."
+    assert args.cores > 0, "Need at least one core."
+    assert args.workers > 0, "Need at least one worker."
+    assert args.adaptive_batch >= 4, "Adaptive batches need at least 4 draws per chain."
+    assert not args.adaptive or args.inference == 'nuts', "Adaptive sampling needs --inference nuts."
+    assert args.warm_tune >= 0, "Warm tuning steps can't be negative."
+    assert not args.warm_start or args.inference == 'nuts', "Warm starts need --inference nuts."
+    assert not args.resume or args.journal is not None, "Resuming needs a --journal."
     return True
 
 def check_overlap(interval, array):
@@ -36,43 +102,716 @@ def check_overlap(interval, array):
     swaghook = (intervals[0,:,0] < intervals[1,:,0]).astype(int)
     return intervals[1-swaghook,np.arange(height),1] > intervals[swaghook,np.arange(height),0]
 
-def check_overlap_bed(interval, array):
-    height = array.shape[0]
-    intervals = np.stack([np.tile(interval,(height,1)), array],axis=0)
-    swaghook = (intervals[0,:,1] < intervals[1,:,1]).astype(int)
-    chrom    = (intervals[0,:,0] == intervals[0,:,0])
-    overlap  = intervals[1-swaghook,np.arange(height),2] > intervals[swaghook,np.arange(height),1]
-    return overlap & chrom
+class WindowModel(object):
+    """
+    Peak calling model for one window, built once for a fixed number 
+    of guide slots. Read counts and the guide-to-group assignment live 
+    in theano shared variables, so moving to a new window only swaps 
+    data in. Slots past the window's guide count are masked out of the 
+    likelihood. Every NUTS run gets a new step, so no tuning carries 
+    over from an earlier window.
+
+    Inputs
+    ----------
+    n_slots: int
+        Number of guides the model can hold.
+    e_mean, e_sd: float or array
+        Prior mean and sd for enhancer_activity, per arm if an array.
+    ct_mean, g_sigma: float
+        Prior mean and sd for guide_intensity.
+    n_arms: int
+        Number of enhancer_activity entries.
+    control_arm: bool
+        Arm 0 is the control group, and enhancer_boost (every other 
+        arm minus arm 0) is tracked.
+    likelihood: str
+        'full' samples guide_intensity for every guide. 'collapsed' 
+        integrates it out: given a guide's total count, its LS count is 
+        Binomial(LS+HS, bin_bias), and the Gamma-Poisson (negative 
+        binomial) total does not depend on enhancer_activity, so only 
+        the activity parameters are sampled.
+    slim: bool
+        Keep only the variables needed downstream in NUTS traces, 
+        rather than every variable and deterministic in the model.
+    """
+    def __init__(self, n_slots, e_mean, e_sd, ct_mean, g_sigma, n_arms=2, control_arm=True, likelihood='full', slim=False):
+        self.n_slots  = n_slots
+        self.n_arms   = n_arms
+        self.likelihood = likelihood
+        self.slim     = slim
+        self.ls_reads = theano.shared(np.zeros(n_slots, dtype=np.int64), 'ls_reads')
+        self.hs_reads = theano.shared(np.zeros(n_slots, dtype=np.int64), 'hs_reads')
+        self.slicer   = theano.shared(np.zeros(n_slots, dtype=np.int64), 'slicer')
+        self.mask     = theano.shared(np.zeros(n_slots, dtype=theano.config.floatX), 'mask')
+        with pm.Model() as self.model:
+            e = pm.Normal('enhancer_activity', mu=e_mean, sigma=e_sd,shape=n_arms)
+            p = pm.Deterministic('bin_bias', tt.nnet.sigmoid(e))
+
+            if control_arm and n_arms == 2:
+                diff = pm.Deterministic('enhancer_boost', e[1]-e[0])
+            elif control_arm and n_arms > 2:
+                diff = pm.Deterministic('enhancer_boost', e[1:]-e[0])
+
+            if likelihood == 'full':
+                g = pm.Gamma('guide_intensity',mu=ct_mean,sigma=g_sigma,shape=n_slots)
+
+                l = pm.Deterministic('low_bin_theta', g*p[self.slicer] )
+                h = pm.Deterministic('high_bin_theta', g*(1-p[self.slicer]) )
+
+                l_ct = pm.Potential('low_reads', tt.sum( self.mask * pm.Poisson.dist(mu=l).logp(self.ls_reads) ))
+                h_ct = pm.Potential('high_reads', tt.sum( self.mask * pm.Poisson.dist(mu=h).logp(self.hs_reads) ))
+            elif likelihood == 'collapsed':
+                n_ct = pm.Potential('low_reads', tt.sum( self.mask * pm.Binomial.dist(n=self.ls_reads+self.hs_reads, 
+                                                                                        p=p[self.slicer]).logp(self.ls_reads) ))
+            else:
+                raise ValueError("Likelihood {} not implemented".format(likelihood))
+        self.warm_state = None
+
+    def set_data(self, ls_reads, hs_reads, slicer):
+        n_guides = len(slicer)
+        assert n_guides <= self.n_slots, "Window has more guides than model slots."
+        pad = self.n_slots - n_guides
+        self.ls_reads.set_value( np.pad(np.asarray(ls_reads, dtype=np.int64), (0,pad), 'constant') )
+        self.hs_reads.set_value( np.pad(np.asarray(hs_reads, dtype=np.int64), (0,pad), 'constant') )
+        self.slicer.set_value( np.pad(np.asarray(slicer, dtype=np.int64), (0,pad), 'constant') )
+        self.mask.set_value( (np.arange(self.n_slots) < n_guides).astype(theano.config.floatX) )
+        return None
+
+    def jitter_start(self):
+        ## Same starting points as pm.sample's default jitter+adapt_diag init
+        return { name: value + np.random.uniform(-1, 1, size=np.shape(value))
+                 for name, value in self.model.test_point.items() }
+
+    def make_step(self, step_size, mean, var, weight):
+        """
+        A new NUTS step whose adaptation starts at the given step size 
+        and at a diagonal mass matrix estimated from `weight` draws 
+        with the given mean and variance. Only constructor arguments 
+        are used: NUTS sets its step size to step_scale / ndim**0.25.
+        """
+        n_dim     = self.model.ndim
+        potential = QuadPotentialDiagAdapt(n_dim, np.asarray(mean, dtype=theano.config.floatX), 
+                                           np.asarray(var, dtype=theano.config.floatX), weight)
+        return pm.NUTS(model=self.model, step_scale=step_size * n_dim**0.25, potential=potential)
+
+    def sample(self, draws, tune, chains, cores, warm=None, keep_state=False):
+        """
+        NUTS from jittered starting points with a new default step, or, 
+        given warm=(step_size, mean, var, weight, starts), from the given 
+        points with a new step whose adaptation starts at that state. A 
+        slim trace holds enhancer_activity, or with keep_state every 
+        free variable in the sampler's parametrization.
+        """
+        if warm is None:
+            step  = pm.NUTS(model=self.model)
+            start = [ self.jitter_start() for _ in range(chains) ]
+        else:
+            step  = self.make_step(*warm[:4])
+            start = warm[4]
+        if not self.slim:
+            trace_vars = None
+        elif keep_state:
+            trace_vars = self.model.vars
+        else:
+            trace_vars = [ self.model.named_vars['enhancer_activity'] ]
+        return pm.sample(draws, tune=tune, chains=chains, cores=cores, trace=trace_vars, 
+                         step=step, start=start, model=self.model)
+
+    def last_points(self, trace):
+        return [ { k: v for k, v in trace.point(-1, chain=c).items() if k in self.model.test_point } 
+                 for c in trace.chains ]
+
+    def adapted_state(self, trace):
+        """
+        Warm start state of a NUTS run: tuned step size, posterior mean 
+        and variance in the sampler's parametrization with the number 
+        of draws behind them, and the last point of each chain.
+        """
+        step_size = np.median([ trace.get_sampler_stats('step_size_bar', chains=c)[-1] 
+                                for c in trace.chains ])
+        ordering  = ArrayOrdering(self.model.vars)
+        flat      = np.zeros((trace.nchains * len(trace), ordering.size))
+        for name, slc, _, _ in ordering.vmap:
+            values = trace.get_values(name)
+            flat[:,slc] = values.reshape(values.shape[0], -1)
+        return step_size, flat.mean(axis=0), flat.var(axis=0), flat.shape[0], self.last_points(trace)
+
+    def sample_warm(self, draws, tune, warm_tune, chains, cores):
+        """
+        NUTS from the state the previous run on this model, in this 
+        process, ended in, with warm_tune tuning steps. A warm run with divergences or 
+        poorly mixed enhancer_activity is thrown away and redone cold 
+        with the full tune. Either way the run seeds the next warm start.
+        """
+        trace = None
+        if self.warm_state is not None and len(self.warm_state[4]) == chains:
+            trace    = self.sample(draws, warm_tune, chains, cores, warm=self.warm_state, keep_state=True)
+            activity = chain_activity(trace)
+            n_div    = trace.get_sampler_stats('diverging').sum()
+            mixed    = all([ split_rhat(activity[:,:,k]) <= ADAPTIVE_RHAT and split_ess(activity[:,:,k]) >= ADAPTIVE_ESS 
+                             for k in range(activity.shape[2]) ])
+            if n_div > 0 or not mixed:
+                print("Warm start rejected ({} divergences, mixed: {}), re-tuning from scratch".format(n_div, mixed),
+                      file=sys.stderr)
+                trace = None
+        if trace is None:
+            trace = self.sample(draws, tune, chains, cores, keep_state=True)
+        self.warm_state = self.adapted_state(trace)
+        return trace
+
+    def sample_adaptive(self, draws, tune, chains, cores, batch, decided, warm_tune=None):
+        """
+        NUTS in batches of `batch` draws per chain, up to `draws`. Later 
+        batches continue each chain from its last point with the first 
+        batch's tuning and no further tuning steps. Stops as soon as 
+        decided(activity) is True for the draws so far. The first batch 
+        is warm started when warm_tune is given.
+
+        Returns
+        ----------
+        activity: array
+            enhancer_activity draws, shaped (chains, draws, arms).
+        divergences: int
+            Divergent transitions over all batches.
+        """
+        if warm_tune is None:
+            trace = self.sample(min(batch, draws), tune, chains, cores, keep_state=True)
+            state = self.adapted_state(trace)
+        else:
+            trace = self.sample_warm(min(batch, draws), tune, warm_tune, chains, cores)
+            state = self.warm_state
+        activity = [ chain_activity(trace) ]
+        n_draws  = activity[0].shape[1]
+        n_div    = trace.get_sampler_stats('diverging').sum()
+        while n_draws < draws and not decided(np.concatenate(activity, axis=1)):
+            trace = self.sample(min(batch, draws - n_draws), 0, chains, cores, 
+                                warm=state[:4] + (self.last_points(trace),), keep_state=True)
+            activity.append( chain_activity(trace) )
+            n_draws += activity[-1].shape[1]
+            n_div   += trace.get_sampler_stats('diverging').sum()
+        return np.concatenate(activity, axis=1), n_div
+
+    def fit_advi(self, draws, n_steps):
+        ## The ADVI objective is compiled on first use and kept. The 
+        ## approximation and optimizer state it updates are reset before 
+        ## each fit, so every window starts where pm.fit would.
+        if not hasattr(self, '_advi_fns'):
+            with self.model:
+                advi = pm.ADVI()
+            step  = advi.objective.step_function()
+            state = [ (x.variable, x.variable.get_value()) for x in step.maker.inputs if x.update is not None ]
+            self._advi_fns = (advi, step, state)
+        advi, step, state = self._advi_fns
+        for variable, value in state:
+            variable.set_value(value)
+        for _ in range(n_steps):
+            step()
+        return advi.approx.sample(draws)
+
+    def fit_laplace(self, draws):
+        """
+        Normal approximation at the posterior mode. Returns None when 
+        the optimizer fails or the mode's Hessian is not positive 
+        definite, so the caller can fall back to NUTS.
+        """
+        ## logp and its derivatives are compiled on first use and kept
+        if not hasattr(self, '_laplace_fns'):
+            bij = DictToArrayBijection(ArrayOrdering(self.model.vars), self.model.test_point)
+            self._laplace_fns = ( bij, 
+                                  bij.mapf(self.model.fastlogp), 
+                                  bij.mapf(self.model.fastdlogp(self.model.vars)), 
+                                  bij.mapf(self.model.fastd2logp(self.model.vars)) )
+        bij, logp, dlogp, d2logp = self._laplace_fns
+        x0  = bij.map(self.model.test_point)
+        opt = scipy.optimize.minimize(lambda x: -logp(x), x0, jac=lambda x: -dlogp(x), method='L-BFGS-B')
+        if not opt.success:
+            print("Laplace mode search failed: {}".format(opt.message),file=sys.stderr)
+            return None
+        ## fastd2logp is already the negated Hessian of logp
+        precision = d2logp(opt.x)
+        try:
+            np.linalg.cholesky(precision)
+        except np.linalg.LinAlgError:
+            print("Laplace Hessian is not positive definite at the mode",file=sys.stderr)
+            return None
+        cov = np.linalg.inv( precision )
+        slc = bij.ordering.by_name['enhancer_activity'].slc
+        activity = np.random.multivariate_normal(opt.x[slc], cov[slc,slc], size=draws)
+        return {'enhancer_activity': activity}
+
+    def infer(self, method, draws=1000, tune=4000, chains=8, cores=8, advi_steps=20000, warm_tune=None):
+        """
+        Posterior draws of enhancer_activity with the chosen engine. 
+        Approximate engines return as many draws as all NUTS chains 
+        combined, so HDRs are estimated from equal sample sizes. NUTS 
+        is warm started when warm_tune is given. A failed Laplace fit 
+        falls back to NUTS.
+        """
+        if method == 'nuts' and warm_tune is not None:
+            return self.sample_warm(draws, tune, warm_tune, chains, cores)
+        elif method == 'nuts':
+            return self.sample(draws, tune, chains, cores)
+        elif method == 'advi':
+            return self.fit_advi(draws * chains, advi_steps)
+        elif method == 'laplace':
+            posterior = self.fit_laplace(draws * chains)
+            if posterior is None:
+                print("Falling back to NUTS",file=sys.stderr)
+                posterior = self.sample(draws, tune, chains, cores)
+            return posterior
+        else:
+            raise ValueError("Inference method {} not implemented".format(method))
+
+def chain_activity(trace):
+    return np.stack([ trace.get_values('enhancer_activity', chains=c) for c in trace.chains ])
+
+def get_model(cache, n_guides, slot_bucket, *model_args, **model_kwargs):
+    n_slots = slot_bucket * math.ceil( float(n_guides) / slot_bucket )
+    key     = (n_slots, model_kwargs.get('n_arms', 2))
+    if key not in cache:
+        print("Compiling model for {} guide slots".format(n_slots),file=sys.stderr)
+        cache[key] = WindowModel(n_slots, *model_args, **model_kwargs)
+    return cache[key]
+
+def get_boost(posterior, ctrl_draws=None, arm=1):
+    activity = posterior['enhancer_activity']
+    if ctrl_draws is None:
+        return activity[:,arm] - activity[:,0]
+    else:
+        return paired_boost(activity[:,arm], ctrl_draws)
+
+def get_call(hdr, rope_threshold):
+    thresh   = [-rope_threshold,rope_threshold]
+    return check_overlap(np.array(thresh),np.expand_dims(hdr,axis=0))[0]
+
+ADAPTIVE_RHAT = 1.01
+ADAPTIVE_ESS  = 400
+ADAPTIVE_Z    = 3.
+ADAPTIVE_BOOT = 100
+
+def split_chains(x):
+    half = x.shape[1] // 2
+    return np.concatenate([ x[:,:half], x[:,half:2*half] ], axis=0)
+
+def split_rhat(x):
+    """
+    Split R-hat of draws shaped (chains, draws).
+    """
+    x = split_chains(x)
+    m, n = x.shape
+    between = n * x.mean(axis=1).var(ddof=1)
+    within  = x.var(axis=1, ddof=1).mean()
+    return np.sqrt( ((n - 1.) / n * within + between / n) / within )
+
+def split_ess(x):
+    """
+    Effective sample size of draws shaped (chains, draws), using 
+    Geyer's initial monotone sequence over split chains.
+    """
+    x = split_chains(x)
+    m, n = x.shape
+    centered = x - x.mean(axis=1, keepdims=True)
+    spectrum = np.fft.rfft(centered, n=2*n, axis=1)
+    acov     = np.fft.irfft(spectrum * np.conj(spectrum), axis=1)[:,:n] / n
+    within   = acov[:,0].mean() * n / (n - 1.)
+    var_plus = within * (n - 1.) / n + x.mean(axis=1).var(ddof=1)
+    rho      = 1. - (within - acov.mean(axis=0)) / var_plus
+    rho[0]   = 1.
+    pairs    = rho[0:n-1:2] + rho[1:n:2]
+    n_pos    = np.argmax(pairs <= 0) if np.any(pairs <= 0) else pairs.shape[0]
+    tau      = -1. + 2. * np.minimum.accumulate(pairs[:n_pos]).sum()
+    return m * n / max(tau, 1. / np.log10(m * n))
+
+def rope_decided(boost, rope_threshold):
+    """
+    Whether enhancer_boost draws shaped (chains, draws) have mixed 
+    and pin down the call. The Monte Carlo error of each HDR bound 
+    is estimated by resampling whole split chains, which keeps their 
+    autocorrelation, and no ROPE bound may lie within ADAPTIVE_Z 
+    errors of an HDR bound.
+    """
+    if split_rhat(boost) > ADAPTIVE_RHAT or split_ess(boost) < ADAPTIVE_ESS:
+        return False
+    hdr    = pm.stats.hpd(boost.reshape(-1),alpha=0.001)
+    pieces = split_chains(boost)
+    picks  = np.random.RandomState(0).randint(pieces.shape[0], size=(ADAPTIVE_BOOT, pieces.shape[0]))
+    boots  = np.stack([ pm.stats.hpd(pieces[pick].reshape(-1),alpha=0.001) for pick in picks ])
+    mc_err = boots.std(axis=0, ddof=1)
+    thresh = np.array([-rope_threshold,rope_threshold])
+    return np.all( np.abs(hdr[:,None] - thresh[None,:]) > ADAPTIVE_Z * mc_err[:,None] )
+
+class GuideWindows(object):
+    """
+    Sparse guide-to-window assignment in CSR form. Window 0 holds the 
+    control guides and windows 1..n_windows hold the targeting guides 
+    overlapping each sliding window, so a window's guides are a slice 
+    of one index array. Memory is O(guides x overlap) rather than 
+    O(guides x windows).
+
+    Inputs
+    ----------
+    window: array
+        Window index of each (guide, window) membership pair.
+    guide: array
+        Guide row index of each pair.
+    n_windows: int
+        Number of windows, including window 0.
+    """
+    def __init__(self, window, guide, n_windows):
+        order = np.lexsort((guide, window))
+        self.guides  = np.asarray(guide, dtype=np.int64)[order]
+        self.indptr  = np.zeros(n_windows+1, dtype=np.int64)
+        np.cumsum(np.bincount(window, minlength=n_windows), out=self.indptr[1:])
+        self.n_windows = n_windows
+
+    def __getitem__(self, i):
+        return self.guides[ self.indptr[i]:self.indptr[i+1] ]
+
+    def __len__(self):
+        return self.n_windows
+
+    def count(self, i):
+        return self.indptr[i+1] - self.indptr[i]
+
+def group_slice(guide_windows, windows, control_arm=True, control_rows=True):
+    """
+    Guide rows for a model over one or more windows, and the 
+    enhancer_activity arm of each guide. With a control arm, window k 
+    takes arm k+1 and the control guides take arm 0 unless 
+    control_rows is False, as when arm 0 only carries a prior from an 
+    earlier control fit. A guide that falls in several windows is 
+    repeated once per window, so each window keeps the likelihood it 
+    would have in its own model.
+    """
+    offset  = int(control_arm)
+    parts   = [ np.zeros(0, dtype=np.int64) ]
+    slicers = [ np.zeros(0, dtype=int) ]
+    if control_arm and control_rows:
+        parts.append( guide_windows[0] )
+        slicers.append( np.zeros(parts[-1].shape[0], dtype=int) )
+    for k, i in enumerate(windows):
+        parts.append( guide_windows[i] )
+        slicers.append( np.full(parts[-1].shape[0], k+offset, dtype=int) )
+    return np.concatenate(parts), np.concatenate(slicers)
+
+def window_key(guide_windows, ls_reads, hs_reads, i):
+    """
+    Digest of a window's guide rows and their downsampled counts. 
+    Windows with equal keys have identical models.
+    """
+    members = guide_windows[i]
+    digest  = hashlib.sha1( members.tobytes() )
+    digest.update( np.ascontiguousarray(ls_reads[members]).tobytes() )
+    digest.update( np.ascontiguousarray(hs_reads[members]).tobytes() )
+    return digest.hexdigest()
+
+class WindowCaller(object):
+    """
+    Fits groups of windows against the job's shared state: guide 
+    counts, the guide-window index, priors and any control fit. Each 
+    process holding a caller compiles its own models, once per guide 
+    slot bucket, so a caller can be shipped to pool workers.
+
+    Inputs
+    ----------
+    ls_reads, hs_reads: array
+        Downsampled read counts for every guide row.
+    guide_windows: GuideWindows
+        Guide rows of each window, window 0 being the controls.
+    priors: tuple
+        (e_mean, e_sd, ct_mean, g_sigma) for window arms.
+    ctrl_prior: tuple
+        (mean, sd) prior of the control arm.
+    ctrl_draws: array or None
+        Control enhancer_activity draws when windows are fit without 
+        a control arm.
+    control_rows: bool
+        Fit the control guides in every window model. Without them the 
+        control arm rests on ctrl_prior alone.
+    args: Namespace
+        Parsed call_peaks arguments.
+    """
+    def __init__(self, ls_reads, hs_reads, guide_windows, priors, ctrl_prior, ctrl_draws, control_rows, args):
+        self.ls_reads = ls_reads
+        self.hs_reads = hs_reads
+        self.guide_windows = guide_windows
+        self.priors   = priors
+        self.ctrl_prior = ctrl_prior
+        self.ctrl_draws = ctrl_draws
+        self.control_arm= ctrl_draws is None
+        self.control_rows = control_rows
+        self.args     = args
+        self.cores    = args.cores
+        self.models   = {}
+
+    def __getstate__(self):
+        ## Compiled models stay with the process that built them
+        state = self.__dict__.copy()
+        state['models'] = {}
+        return state
+
+    def __call__(self, group):
+        args = self.args
+        reset_peak_rss()
+        e_mean, e_sd, ct_mean, g_sigma = self.priors
+        if len(group) == 1:
+            print("Starting wnd_{}".format(group[0]))
+        else:
+            print("Starting wnd_{} to wnd_{} jointly".format(group[0], group[-1]))
+        use_idx, slicer = group_slice(self.guide_windows, group, self.control_arm, self.control_rows)
+        e_mu  = np.array( [self.ctrl_prior[0]]*int(self.control_arm) + [e_mean]*len(group) )
+        e_sig = np.array( [self.ctrl_prior[1]]*int(self.control_arm) + [e_sd]*len(group) )
+
+        compile_start = time.time()
+        model = get_model(self.models, slicer.shape[0], args.slot_bucket, 
+                          e_mu, e_sig, ct_mean, g_sigma, 
+                          n_arms=e_mu.shape[0], control_arm=self.control_arm, likelihood=args.likelihood, 
+                          slim=args.slim_trace)
+        compile_time  = time.time() - compile_start
+        model.set_data(self.ls_reads[use_idx], self.hs_reads[use_idx], slicer)
+        arms = range(int(self.control_arm), e_mu.shape[0])
+        warm_tune = args.warm_tune if args.warm_start else None
+        sample_start = time.time()
+        if args.adaptive:
+            def decided(activity):
+                for arm in arms:
+                    boost = get_boost({'enhancer_activity': activity.reshape(-1, activity.shape[2])}, 
+                                      self.ctrl_draws, arm=arm)
+                    if not rope_decided(boost.reshape(activity.shape[:2]), args.rope_threshold):
+                        return False
+                return True
+            activity, n_div = model.sample_adaptive(args.draws, args.tune, args.chains, self.cores, 
+                                                    args.adaptive_batch, decided, warm_tune=warm_tune)
+            n_draws   = activity.shape[0] * activity.shape[1]
+            posterior = {'enhancer_activity': activity.reshape(-1, activity.shape[2])}
+        else:
+            posterior = model.infer(args.inference, draws=args.draws, tune=args.tune, 
+                                    chains=args.chains, cores=self.cores, advi_steps=args.advi_steps, 
+                                    warm_tune=warm_tune)
+            n_draws   = args.draws * args.chains
+            if args.inference == 'nuts':
+                activity = chain_activity(posterior)
+                n_div    = posterior.get_sampler_stats('diverging').sum()
+        sample_time = time.time() - sample_start
+
+        stats = OrderedDict([ ('guides', int(slicer.shape[0])), ('group_size', len(group)), 
+                              ('compile_seconds', compile_time), ('sampling_seconds', sample_time), 
+                              ('draws', int(n_draws)), ('divergences', None), ('rhat', None), 
+                              ('ess_per_sec', None), ('peak_rss_mb', peak_rss()) ])
+        if args.inference == 'nuts':
+            stats['divergences'] = int(n_div)
+            stats['rhat']        = float(max([ split_rhat(activity[:,:,k]) for k in range(activity.shape[2]) ]))
+            stats['ess_per_sec'] = float(min([ split_ess(activity[:,:,k]) for k in range(activity.shape[2]) ]) / sample_time)
+        results = []
+        for i, arm in zip(group, arms):
+            boost = get_boost(posterior, self.ctrl_draws, arm=arm)
+            hdr = pm.stats.hpd(boost,alpha=0.001)
+            results.append( (i, hdr, get_call(hdr, args.rope_threshold), stats) )
+        return results
+
+_WORKER_CALLER = None
+
+def init_worker(caller, counter):
+    global _WORKER_CALLER
+    _WORKER_CALLER = caller
+    ## Pool workers are daemonic and can't fork chain processes
+    _WORKER_CALLER.cores = 1
+    ## Forked workers inherit the parent's RNG state, which pymc3 draws 
+    ## chain seeds from, so give each worker its own seed
+    with counter.get_lock():
+        worker_index  = counter.value
+        counter.value += 1
+    np.random.seed( (caller.args.random_seed + 1 + worker_index) % 2**32 )
+
+def worker_call(group):
+    return _WORKER_CALLER(group)
+
+def run_windows(caller, window_groups, workers=1):
+    """
+    Fit window groups in order, or spread them over a process pool 
+    with the groups holding the most guides dispatched first. Yields 
+    (window, hdr, call, stats) as groups finish.
+    """
+    if workers == 1:
+        for group in window_groups:
+            for result in caller(group):
+                yield result
+    else:
+        sizes = [ sum([ caller.guide_windows.count(i) for i in group ]) for group in window_groups ]
+        order = np.argsort(sizes, kind='stable')[::-1]
+        counter = multiprocessing.Value('i', 0)
+        pool  = multiprocessing.Pool(workers, initializer=init_worker, initargs=(caller, counter))
+        try:
+            for group_results in pool.imap_unordered(worker_call, [ window_groups[j] for j in order ], chunksize=1):
+                for result in group_results:
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+
+class Telemetry(object):
+    """
+    JSON lines sidecar of stage wall times and per-window fit 
+    statistics. Every record carries the job index, so sidecars from 
+    the chunks of a split run can simply be concatenated. With no path 
+    nothing is written.
+    """
+    def __init__(self, path, job_index):
+        self.handle    = open(path, 'a') if path is not None else None
+        self.job_index = job_index
+
+    def write(self, record_type, fields):
+        if self.handle is None:
+            return None
+        record = OrderedDict([ ('type', record_type), ('job_index', self.job_index) ])
+        record.update( fields )
+        print(json.dumps(record), file=self.handle)
+        self.handle.flush()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block. Entries added to the yielded dict are 
+        written with the stage record.
+        """
+        extra = OrderedDict()
+        start = time.time()
+        yield extra
+        fields = OrderedDict([ ('stage', name), ('seconds', time.time() - start) ])
+        fields.update( extra )
+        self.write('stage', fields)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+
+JOURNAL_KEYS = ['input_data','job_index','job_range','window_size','step_size',
+                'rope_threshold','no_offsets','control_mode','likelihood','inference',
+                'advi_steps','joint_windows','draws','tune','chains','adaptive','adaptive_batch',
+                'warm_start','warm_tune','random_seed']
+
+def journal_config(args):
+    return OrderedDict([ (key, getattr(args, key)) for key in JOURNAL_KEYS ])
+
+def read_journal(path):
+    """
+    Settings header and finished windows of a results journal. A line 
+    cut short by an interrupted write is dropped.
+    """
+    done = OrderedDict()
+    with open(path, 'r') as f:
+        header = json.loads( f.readline().lstrip('#') )
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            try:
+                assert len(fields) == 5 and line.endswith('\n')
+                done[int(fields[0])] = ( np.array([float(fields[1]), float(fields[2])]), 
+                                         fields[3] == 'True', int(fields[4]) )
+            except (AssertionError, ValueError):
+                print("Dropping incomplete journal line: {}".format(line.rstrip()),file=sys.stderr)
+    return header, done
+
+class ResultJournal(object):
+    """
+    Append-only record of finished windows. The settings header and 
+    any entries carried over from an earlier run are rewritten first, 
+    then every new window is flushed and synced to disk as soon as it 
+    finishes, so an interrupted job loses at most the windows in flight.
+    """
+    def __init__(self, path, config, done):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            print('#' + json.dumps(config), file=f)
+            for i, (hdr, the_call, n_draws) in done.items():
+                print("{}\t{}\t{}\t{}\t{}".format(i, hdr[0], hdr[1], the_call, n_draws), file=f)
+        os.replace(tmp_path, path)
+        self.handle = open(path, 'a')
+
+    def record(self, i, hdr, the_call, n_draws):
+        print("{}\t{}\t{}\t{}\t{}".format(i, hdr[0], hdr[1], the_call, n_draws), file=self.handle)
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def close(self):
+        self.handle.close()
+
+def paired_boost(window_draws, ctrl_draws):
+    """
+    enhancer_boost draws from a window-only fit and a separate control 
+    fit. Control and window guides share no parameters, so the joint 
+    posterior factorizes and independent draws can be paired directly.
+    """
+    if ctrl_draws.shape[0] != window_draws.shape[0]:
+        ctrl_draws = np.random.choice(ctrl_draws, size=window_draws.shape[0], replace=True)
+    return window_draws - ctrl_draws
+
+def report_comparisons(comparisons, args):
+    """
+    Summarize agreement between the chosen configuration and the 
+    reference model on the --compare_windows subset.
+    """
+    report = pd.DataFrame(comparisons, columns=['window','lo','hi','pass',
+                                                'ref_lo','ref_hi','ref_pass'])
+    report['agree'] = report['pass'] == report['ref_pass']
+    report['d_lo']  = report['lo'] - report['ref_lo']
+    report['d_hi']  = report['hi'] - report['ref_hi']
+    if args.compare_report is not None:
+        report.to_csv(args.compare_report, sep='\t', index=False)
+    else:
+        print(report.to_csv(sep='\t', index=False),file=sys.stderr)
+    print("Compared {} windows ({}, {} likelihood, {} controls vs. reference): ".format(
+              report.shape[0], args.inference, args.likelihood, args.control_mode) +\
+          "call agreement {:.3f}, mean |d_lo| {:.4f}, mean |d_hi| {:.4f}".format(
+              report['agree'].mean(), report['d_lo'].abs().mean(), report['d_hi'].abs().mean()),
+          file=sys.stderr)
+    return report
 
 def main(args):
     print("Begin",file=sys.stderr)
     check_args(args)
+    ## Pick up earlier results, and their random seed, on resume
+    journal_path = args.journal
+    done = OrderedDict()
+    if args.resume and os.path.exists(journal_path):
+        header, done = read_journal(journal_path)
+        if args.random_seed is None:
+            args.random_seed = header['random_seed']
+        assert header == json.loads(json.dumps(journal_config(args))), \
+               "Journal {} was written with different settings, can't resume.".format(journal_path)
+        print("Resuming with {} windows done".format(len(done)),file=sys.stderr)
+    if args.random_seed is None:
+        args.random_seed = np.random.randint(2**31 - 1)
+    np.random.seed(args.random_seed)
+    telemetry = Telemetry(args.telemetry, args.job_index)
+    telemetry.write('run', journal_config(args))
     #######################################
     ##
     ## Import Data, remove missing guides
     ##
     #######################################
     print("Import Data, remove missing guides",file=sys.stderr)
-    data = pd.read_table(args.input_data, sep="\t", header=0)
-    hs_zero = data['HS_reads'] > 0
-    ls_zero = data['LS_reads'] > 0
-    rm_zero = hs_zero & ls_zero
-    data = data[ rm_zero ]
+    with telemetry.stage('load'):
+        data = pd.read_table(args.input_data, sep="\t", header=0)
+        hs_zero = data['HS_reads'] > 0
+        ls_zero = data['LS_reads'] > 0
+        rm_zero = hs_zero & ls_zero
+        data = data[ rm_zero ]
     #######################################
     ##
     ## Downsample larger lib to comparible
     ##
     #######################################
     print("Downsample",file=sys.stderr)
-    ## Rescale to floats
-    rescale = min(data['LS_reads'].sum(),data['HS_reads'].sum()) / data.loc[:,('HS_reads','LS_reads')].sum(axis=0)
-    data.loc[:,('HS_reads','LS_reads')] *= rescale
-    ## Sample downsized library
-    runif              = np.random.uniform(size=data.loc[:,('HS_reads','LS_reads')].shape)
-    int_part, sample_p = np.divmod( data.loc[:,('HS_reads','LS_reads')], 1 )
-    data.loc[:,('HS_reads','LS_reads')] = int_part + (runif < sample_p)
-    ## Return as int
-    data.loc[:,('HS_reads','LS_reads')] = data.loc[:,('HS_reads','LS_reads')].astype(int) + 1
+    with telemetry.stage('downsample'):
+        ## Rescale to floats
+        rescale = min(data['LS_reads'].sum(),data['HS_reads'].sum()) / data.loc[:,('HS_reads','LS_reads')].sum(axis=0)
+        data.loc[:,('HS_reads','LS_reads')] *= rescale
+        ## Sample downsized library
+        runif              = np.random.uniform(size=data.loc[:,('HS_reads','LS_reads')].shape)
+        int_part, sample_p = np.divmod( data.loc[:,('HS_reads','LS_reads')], 1 )
+        data.loc[:,('HS_reads','LS_reads')] = int_part + (runif < sample_p)
+        ## Return as int
+        data.loc[:,('HS_reads','LS_reads')] = data.loc[:,('HS_reads','LS_reads')].astype(int) + 1
     #######################################
     ##
     ## Calc. simple data representations
@@ -86,70 +825,46 @@ def main(args):
     ##
     #######################################
     print("Parse positional information",file=sys.stderr)
-    ## Line guide effects up to genome
-    targ_data = data[ (~data['Coordinates'].str.contains("NT")) &\
-                      (~data['Coordinates'].str.contains('CTRL')) &\
-                      (~data['Coordinates'].str.contains('FILLER-LV2')) &\
-                      (~data['Coordinates'].str.contains('FILLER-SgO')) ]
-    if args.no_offsets:
-        plus_offsets = [0, 0]
-        minus_offsets= [0, 0]
-    else:
-        plus_offsets = [152, 147]
-        minus_offsets= [146, 153]
-    uniq_chrom= np.unique([coord.split(':')[0] for coord in targ_data['Coordinates']])
-    chrom2idx = OrderedDict( [ (x,i) for i,x in enumerate(uniq_chrom) ] )
-    idx2chrom = OrderedDict( [ (i,x) for i,x in enumerate(uniq_chrom) ] )
-    pos_array = np.array([ ( chrom2idx[coord.split(':')[0]],
-                             int(coord.split(':')[1].split('-')[1]) - plus_offsets[0],
-                             int(coord.split(':')[1].split('-')[1]) + plus_offsets[1] ) if coord.split(':')[2] == '+' 
-                           else ( chrom2idx[coord.split(':')[0]],
-                                  int(coord.split(':')[1].split('-')[1]) - minus_offsets[0],
-                                  int(coord.split(':')[1].split('-')[1]) + minus_offsets[1] )
-                           for coord in targ_data['Coordinates'] ])
+    with telemetry.stage('parse'):
+        if args.no_offsets:
+            plus_offsets = [0, 0]
+            minus_offsets= [0, 0]
+        else:
+            plus_offsets = [152, 147]
+            minus_offsets= [146, 153]
+        guides    = parse_guide_coords(data['Coordinates'], plus_offsets, minus_offsets)
+        ## Line guide effects up to genome
+        targ_data = data[ (guides['guide_class'] == GUIDE_TARGETING).values ]
+        targ_guides = guides[ (guides['guide_class'] == GUIDE_TARGETING).values ]
+        assert targ_guides['chrom'].notnull().all(), "Targeting guide Coordinates must look like chr:start-end:strand."
+        targ_chrom= targ_guides['chrom'].cat.remove_unused_categories()
+        uniq_chrom= targ_chrom.cat.categories.values.astype(str)
+        idx2chrom = OrderedDict( [ (i,x) for i,x in enumerate(uniq_chrom) ] )
+        pos_array = np.stack([ targ_chrom.cat.codes.values.astype(np.int64), 
+                               targ_guides['target_start'].values.astype(np.int64), 
+                               targ_guides['target_end'].values.astype(np.int64) ], axis=1)
     ## Get genomic windows
-    genome_lims = OrderedDict(
-        [ (idx, 
-           (pos_array[pos_array[:,0] == idx, 1].min(),
-            pos_array[pos_array[:,0] == idx, 2].max())
-          ) for idx, chrom in idx2chrom.items() ] 
-    )
-    sliding_window = [ (idx, np.vstack( (np.arange(*lims,args.step_size),
-                                        np.minimum(np.arange(*lims,args.step_size)+args.window_size,lims[1])) ).T 
-                       )
-                       for idx, lims in genome_lims.items() ]
-    sliding_window = np.concatenate(
-        [ np.concatenate( (np.tile( [[idx]], (a_window.shape[0],1) ), a_window), axis=1 ) 
-          for idx, a_window in sliding_window ]
-    )
-    sliding_window = sliding_window[[ np.any(check_overlap_bed(interval,pos_array)) 
-                                      for interval in sliding_window ]]
-    ## Get chromosome
-    chrom = targ_data['Coordinates'].iloc[0].split(':')[0]
+    with telemetry.stage('windowing'):
+        sliding_window = get_sliding_windows(pos_array, args.window_size, args.step_size)
     #######################################
     ##
     ## Process guide data 
     ##
     #######################################
     print("Process guide data",file=sys.stderr)
-    ovl_array = np.stack([ check_overlap_bed(guide_interval,sliding_window) 
-                           for guide_interval in pos_array ],axis=0).astype(int)
-    ovl_array = np.concatenate((np.zeros_like(ovl_array[:,0:1]),ovl_array),axis=1)
-    ovl_dex = pd.DataFrame(ovl_array,columns=["wnd_{}".format(i) for i in np.arange(ovl_array.shape[1])])
-
-    NT_count = data.loc[(data['Coordinates'].str.contains("NT") | data['Coordinates'].str.contains("CTRL")),('Coordinates','HS_reads','LS_reads')].shape[0]
-    NT_hold = np.zeros((NT_count,ovl_array.shape[1])).astype(int)
-    NT_hold[:,0] = 1
-    NT_dex = pd.DataFrame(NT_hold,columns=["wnd_{}".format(i) for i in np.arange(ovl_array.shape[1])])
-    
-    wind_data = pd.concat((
-        pd.concat((data.loc[(data['Coordinates'].str.contains("NT") | data['Coordinates'].str.contains("CTRL")),('Coordinates','HS_reads','LS_reads')].reset_index(drop=True),
-               NT_dex.reset_index(drop=True)),axis=1).reset_index(drop=True)
-        ,
-        pd.concat((targ_data.loc[:,('Coordinates','HS_reads','LS_reads')].reset_index(drop=True),
-                   ovl_dex.reset_index(drop=True)),axis=1).reset_index(drop=True)
-    ), axis=0, ignore_index=True)
-    max_idx = max([ int(item.replace('wnd_','')) for item in wind_data.columns if 'wnd' in item ])
+    ctrl_data = data.loc[(guides['guide_class'] == GUIDE_CONTROL).values,('Coordinates','HS_reads','LS_reads')]
+    guide_data= pd.concat((ctrl_data, targ_data.loc[:,('Coordinates','HS_reads','LS_reads')]), 
+                          axis=0, ignore_index=True)
+    ls_reads  = guide_data['LS_reads'].values
+    hs_reads  = guide_data['HS_reads'].values
+    n_ctrl    = ctrl_data.shape[0]
+    ## Guide-window membership pairs, window 0 holds the controls
+    with telemetry.stage('overlap'):
+        pair_wnd, pair_guide = get_window_overlaps(pos_array, sliding_window)
+        pair_wnd  = np.concatenate([ np.zeros(n_ctrl, dtype=np.int64), pair_wnd + 1 ])
+        pair_guide= np.concatenate([ np.arange(n_ctrl, dtype=np.int64), pair_guide + n_ctrl ])
+        guide_windows = GuideWindows(pair_wnd, pair_guide, sliding_window.shape[0] + 1)
+    max_idx = sliding_window.shape[0]
     #######################################
     ##
     ## Call peaks on chunk
@@ -160,62 +875,123 @@ def main(args):
     start_idx = 1 + (chunk_size * args.job_index)
     end_idx = start_idx + chunk_size
     
-    peak_calls = []
-    diff_hdr   = []
-        
-    for i in range(start_idx,min(max_idx,end_idx)):
-        print("Starting wnd_{}".format(i))
-        group0 =  (wind_data['wnd_0'] == 1).astype(int)
-        group1 =  (wind_data['wnd_{}'.format(i)] == 1).astype(int)
-        slicer = np.vstack([group0, group1]).T
-        use_data = wind_data[ np.sum(slicer,axis=1) == 1 ]
-        slicer = slicer[ np.sum(slicer,axis=1) == 1 ]
-        slicer = np.argmax(slicer, axis=1)
-        e_mean = np.mean(np.log(wind_data['LS_reads'] / wind_data['HS_reads']))
-        e_sd   = np.std(np.log(wind_data['LS_reads'] / wind_data['HS_reads']))
-        ct_mean= np.mean(wind_data['LS_reads'].values+ wind_data['HS_reads'].values)
-        ct_sd  = np.std(wind_data['LS_reads'].values+ wind_data['HS_reads'].values)
-        g_var  = (ct_sd**2) - ct_mean
-        if g_var <= 0:
-            g_sigma = ct_sd
-            print("Warning! Count data is underdispersed, results may be inaccurate.")
+    ## Priors are shared by every window, set them once
+    e_mean = np.mean(np.log(ls_reads / hs_reads))
+    e_sd   = np.std(np.log(ls_reads / hs_reads))
+    ct_mean= np.mean(ls_reads + hs_reads)
+    ct_sd  = np.std(ls_reads + hs_reads)
+    g_var  = (ct_sd**2) - ct_mean
+    if g_var <= 0:
+        g_sigma = ct_sd
+        print("Warning! Count data is underdispersed, results may be inaccurate.")
+    else:
+        g_sigma = np.sqrt(g_var)
+    base_priors = (e_mean, e_sd, ct_mean, g_sigma)
+    ## Fit control arm once, if requested
+    ctrl_draws = None
+    ctrl_prior = (e_mean, e_sd)
+    if args.control_mode != 'joint':
+        with telemetry.stage('control_fit'):
+            print("Fit control guides",file=sys.stderr)
+            ctrl_idx, ctrl_slicer = group_slice(guide_windows, [])
+            ctrl_model = WindowModel(ctrl_idx.shape[0], e_mean, e_sd, ct_mean, g_sigma, 
+                                     n_arms=1, control_arm=False, likelihood=args.likelihood, slim=args.slim_trace)
+            ctrl_model.set_data(ls_reads[ctrl_idx], hs_reads[ctrl_idx], ctrl_slicer)
+            fit_draws = ctrl_model.infer(args.inference, draws=args.draws, tune=args.tune, chains=args.chains, 
+                                         cores=args.cores, advi_steps=args.advi_steps)['enhancer_activity'][:,0]
+            if args.control_mode == 'samples':
+                ctrl_draws = fit_draws
+            else:
+                ctrl_prior = (fit_draws.mean(), fit_draws.std())
+    with telemetry.stage('sampling') as info:
+        ## Windows with the same guides and counts are fit once
+        window_ids = list(range(start_idx,min(max_idx,end_idx)))
+        results = dict(done)
+        journal = ResultJournal(journal_path, journal_config(args), done) if journal_path is not None else None
+        cache   = {}
+        for i in done:
+            cache[ window_key(guide_windows, ls_reads, hs_reads, i) ] = done[i]
+        duplicates = OrderedDict()
+        cache_hits = 0
+        for i in window_ids:
+            if i in done:
+                continue
+            key = window_key(guide_windows, ls_reads, hs_reads, i)
+            if key in cache:
+                results[i] = cache[key]
+                if journal is not None:
+                    journal.record(i, *results[i])
+                cache_hits += 1
+            elif key in duplicates:
+                duplicates[key].append(i)
+                cache_hits += 1
+            else:
+                duplicates[key] = [i]
+        todo_ids = [ members[0] for members in duplicates.values() ]
+        print("{} of {} windows served from cache".format(cache_hits, len(window_ids)-len(done)),file=sys.stderr)
+        info['windows']    = len(window_ids) - len(done)
+        info['cache_hits'] = cache_hits
+        ## Windows fit together share one model
+        if args.joint_windows and len(todo_ids) > 0:
+            window_groups = [ todo_ids ]
         else:
-            g_sigma = np.sqrt(g_var)
-            
-        with pm.Model() as model:
-            g = pm.Gamma('guide_intensity',mu=ct_mean,sigma=g_sigma,shape=slicer.shape[0])
-
-            e = pm.Normal('enhancer_activity', mu=e_mean, sigma=e_sd,shape=2)
-            p = pm.Deterministic('bin_bias', tt.nnet.sigmoid(e))
+            window_groups = [ [i] for i in todo_ids ]
+        caller = WindowCaller(ls_reads, hs_reads, guide_windows, base_priors, 
+                              ctrl_prior, ctrl_draws, args.control_mode == 'joint', args)
+        n_sampled = []
+        for i, hdr, the_call, stats in run_windows(caller, window_groups, args.workers):
+            print("wnd_{} used {} draws, peak RSS {:.0f} MB".format(i, stats['draws'], stats['peak_rss_mb']))
+            n_sampled.append( stats['draws'] )
+            locus = sliding_window[i-1]
+            telemetry.write('window', OrderedDict([ ('window', i), ('chrom', idx2chrom[locus[0]]), 
+                                                    ('start', int(locus[1])), ('end', int(locus[2])) ] + list(stats.items())))
+            for j in duplicates[ window_key(guide_windows, ls_reads, hs_reads, i) ]:
+                results[j] = (hdr, the_call, stats['draws'])
+                if journal is not None:
+                    journal.record(j, hdr, the_call, stats['draws'])
+        if journal is not None:
+            journal.close()
+        if len(n_sampled) > 0:
+            print("Sampled {} draws over {} windows, {:.1%} of the full budget".format(
+                      sum(n_sampled), len(n_sampled), sum(n_sampled) / float(len(n_sampled) * args.draws * args.chains)),
+                  file=sys.stderr)
 
-            l = pm.Deterministic('low_bin_theta', g*p[slicer] )
-            h = pm.Deterministic('high_bin_theta', g*(1-p[slicer]) )
-
-            diff = pm.Deterministic('enhancer_boost', e[1]-e[0])
-
-            l_ct = pm.Poisson('low_reads', mu=l, observed=use_data['LS_reads'])
-            h_ct = pm.Poisson('high_reads', mu=h, observed=use_data['HS_reads'])
-
-        with model:
-            trace = pm.sample(1000, tune=4000, cores=8)
-
-        hdr = pm.stats.hpd(trace['enhancer_boost'],alpha=0.001)
-        thresh   = [-args.rope_threshold,args.rope_threshold]
-        the_call = check_overlap(np.array(thresh),np.expand_dims(hdr,axis=0))[0]
+    ## Reference fits for --compare_windows
+    if args.compare_windows is not None:
+        compare_set = set([ int(x) for x in args.compare_windows.split(',') ])
+    else:
+        compare_set = set()
+    ref_models  = {}
+    comparisons = []
+    for i in window_ids:
+        if i in compare_set:
+            print("Reference fit for wnd_{}".format(i))
+            ref_idx, ref_slicer = group_slice(guide_windows, [i])
+            ref_model = get_model(ref_models, ref_slicer.shape[0], args.slot_bucket, 
+                                  *base_priors)
+            ref_model.set_data(ls_reads[ref_idx], hs_reads[ref_idx], ref_slicer)
+            ref_hdr  = pm.stats.hpd(get_boost(ref_model.infer('nuts', draws=args.draws, tune=args.tune, 
+                                                              chains=args.chains, cores=args.cores)),alpha=0.001)
+            ref_call = get_call(ref_hdr, args.rope_threshold)
+            hdr, the_call = results[i][:2]
+            comparisons.append( [i, hdr[0], hdr[1], the_call == False, 
+                                 ref_hdr[0], ref_hdr[1], ref_call == False] )
 
-        peak_calls.append( the_call )
-        diff_hdr.append(hdr)
+    if len(comparisons) > 0:
+        report_comparisons(comparisons, args)
         
-    with open(args.output_data, 'w') as f:
-        for i,j in enumerate(range(start_idx,min(max_idx,end_idx))):
-            peak_position = sliding_window[j-1]
-            region_hdr    = diff_hdr[i]
-            region_call   = peak_calls[i] == False
-            interval_info = [idx2chrom[peak_position[0]],
-                             peak_position[1],peak_position[2],
-                             "{},{}".format(*region_hdr),region_call,'.']
-            print("{}\t{}\t{}\t{}\t{}\t{}".format(*interval_info),file=f)
+    with telemetry.stage('output'):
+        with open(args.output_data, 'w') as f:
+            for j in window_ids:
+                peak_position = sliding_window[j-1]
+                region_hdr    = results[j][0]
+                region_call   = results[j][1] == False
+                interval_info = [idx2chrom[peak_position[0]],
+                                 peak_position[1],peak_position[2],
+                                 "{},{}".format(*region_hdr),region_call,'.']
+                print("{}\t{}\t{}\t{}\t{}\t{}".format(*interval_info),file=f)
         
+    telemetry.close()
     print("Done.",file=sys.stderr)
     
 if __name__ == "__main__":
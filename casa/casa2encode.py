@@ -33,6 +33,7 @@ def get_args():
     parser.add_argument('--gff_file',help='Gene definitions with items in the `geneID` column matching the `gene` column of the CASA post-processed peak files. Unused argument, feature in progress.')
     parser.add_argument('--min_guide_coverage', type=int, default=1, help='Minimum guide coverage for reporting peaks if using raw CASA output files.')
     parser.add_argument('--use_singletons', action='store_true', help='Singleton flag for replicating peaks call.')
+    parser.add_argument('--min_replicates', type=int, default=2, help='Minimum number of overlapping replicates for replicating peaks call.')
     parser.add_argument('--chrTSS', required=True, help='Chromosome of target transcription start site. (i.e., chrX).')
     parser.add_argument('--startTSS', required=True, help='First promoter nucleotide position.')
     parser.add_argument('--strandGene', required=True, help='Sense strand of target gene.')
@@ -67,7 +68,7 @@ def collect(args):
     return test_peaks
 
 def merge_and_filter(peaks, args):
-    rep_peaks = get_replicating_peaks( peaks )
+    rep_peaks = get_replicating_peaks( peaks, use_singletons=args.use_singletons, min_replicates=args.min_replicates )
     fil_peaks = filter_by_guide_coverage( rep_peaks, 
                                           pd.read_table( args.casa_guide_file, sep='\t', header=0 )['Coordinates'],
                                           min_coverage=args.min_guide_coverage
@@ -77,12 +78,14 @@ def merge_and_filter(peaks, args):
 def get_bed_format(peaks, args):
     scored_peaks = []
     scores = get_peak_strengths(*args.casa_peak_files)
-    for i, a_peak in peaks.iterrows():
+    peak_hit, score_hit = IntervalIndex(scores).query(peaks.loc[:,('chr','start','end')].values)
+    hit_bounds = np.searchsorted(peak_hit, np.arange(peaks.shape[0]+1))
+    for k, (i, a_peak) in enumerate(peaks.iterrows()):
         assemble_ = [a_peak['chr'],a_peak['start'],a_peak['end']]
-        hits = check_overlap_bed(assemble_, scores.loc[:,('chr','start','end')].values)
-        grab_scores = scores.loc[hits, 'score']
-        grab_pass   = scores.loc[hits, 'pass']
-        grab_sign   = scores.loc[hits, 'sign']
+        hits = score_hit[ hit_bounds[k]:hit_bounds[k+1] ]
+        grab_scores = scores['score'].iloc[hits]
+        grab_pass   = scores['pass'].iloc[hits]
+        grab_sign   = scores['sign'].iloc[hits]
         conflict    = sum([ int(y) if x else 0 for x,y in zip(grab_pass,grab_sign) ]) != grab_pass.sum()
         summit = np.argmax(np.abs(np.array(grab_scores)))
         peak_score  = grab_scores.iloc[summit]
@@ -1,129 +1,412 @@
+import io
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 
 def merge_intervals(intervals, count=False, req_overlap=False):
+    """
+    Merge overlapping rows of an (N, 2+) interval array after sorting by 
+    start. A row joins the current merged interval when it starts at or 
+    before that interval's end (strictly before with req_overlap). 
+    Group breaks come from a running max of ends, and merged ends from 
+    maximum.reduceat, so there is no per-row Python loop. Assumes 
+    intervals have end >= start.
+    """
     sorted_intervals = intervals[ intervals[:,0].argsort() ]
-    merged_intervals = sorted_intervals[0:1]
-    counts = [1]
-    offset = int(req_overlap)
-    for i in range(1,sorted_intervals.shape[0]):
-        next_interval = sorted_intervals[i:i+1]
-        last_interval = merged_intervals[-1:]
-        if next_interval[0,0] <= (last_interval[0,1]-offset):
-            new_max = max( next_interval[0,1], last_interval[0,1] )
-            merged_intervals[-1,1] = new_max
-            counts[-1] += 1
-        else:
-            merged_intervals = np.concatenate([merged_intervals,next_interval], 
-                                              axis=0)
-            counts.append(1)
+    if sorted_intervals.shape[0] == 0:
+        merged_intervals, counts = sorted_intervals[0:1], [1]
+    else:
+        group_start = _merge_breaks(sorted_intervals[:,0], np.maximum.accumulate(sorted_intervals[:,1]), 
+                                    int(req_overlap))
+        merged_intervals, counts = _merge_groups(sorted_intervals, group_start)
     if count:
         return merged_intervals, counts
     else:
         return merged_intervals
 
+def _merge_breaks(starts, run_max, offset, new_chrom=None):
+    group_start     = np.ones(starts.shape[0], dtype=bool)
+    group_start[1:] = starts[1:] > (run_max[:-1] - offset)
+    if new_chrom is not None:
+        group_start |= new_chrom
+    return np.nonzero(group_start)[0]
+
+def _merge_groups(sorted_intervals, group_start):
+    merged_intervals = sorted_intervals[group_start]
+    merged_intervals[:,1] = np.maximum.reduceat(sorted_intervals[:,1], group_start)
+    counts = np.diff(np.append(group_start, sorted_intervals.shape[0])).tolist()
+    return merged_intervals, counts
+
+def _merge_keyed(keys, starts, ends, offset):
+    """
+    Sort rows by (key, start) and find where merged groups begin, with 
+    running maxima of ends taken per key and a break at every new key. 
+    Returns the sort order and group starts in sorted coordinates.
+    """
+    order   = np.lexsort((starts, keys))
+    keys_   = keys[order]
+    new_key = np.ones(order.shape[0], dtype=bool)
+    new_key[1:] = keys_[1:] != keys_[:-1]
+    run_max = pd.Series(ends[order]).groupby(keys_).cummax().values
+    return order, _merge_breaks(starts[order], run_max, offset, new_key)
+
 def merge_bed(bed_df, count=False, req_overlap=False):
-    bed_ = bed_df.sort_values(['chr','start'],axis=0) \
-                 .reset_index(drop=True)
-    chr_set = bed_['chr'].unique()
-    hold_   = []
-    for chrom in chr_set:
-        sub_bed = bed_.loc[ bed_['chr'] == chrom, ('start','end') ]
-        if count:
-            merged_pos, counts = merge_intervals(sub_bed.values, True, req_overlap)
-            reorg_df= pd.DataFrame({'chr': chrom, 
-                                    'start': merged_pos[:,0],
-                                    'end': merged_pos[:,1], 
-                                    'count': counts})
-        else:
-            merged_pos = merge_intervals(sub_bed.values, False, req_overlap)
-            reorg_df= pd.DataFrame({'chr': chrom, 
-                                    'start': merged_pos[:,0],
-                                    'end': merged_pos[:,1]})
-        hold_.append(reorg_df)
-    return pd.concat(hold_, axis=0).reset_index(drop=True)
+    """
+    merge_intervals over every chromosome of a chr/start/end DataFrame 
+    at once: one sort, with running maxima of ends taken per 
+    chromosome.
+    """
+    columns = ['chr','start','end','count'] if count else ['chr','start','end']
+    if bed_df.shape[0] == 0:
+        return pd.DataFrame(columns=columns)
+    chrom_code, chroms = pd.factorize(bed_df['chr'], sort=True)
+    positions   = bed_df.loc[:,('start','end')].values
+    order, group_start = _merge_keyed(chrom_code, positions[:,0], positions[:,1], int(req_overlap))
+    merged_pos, counts = _merge_groups(positions[order], group_start)
+    reorg_df = pd.DataFrame({'chr': bed_df['chr'].values[order[group_start]], 
+                             'start': merged_pos[:,0],
+                             'end': merged_pos[:,1], 
+                             'count': counts})
+    return reorg_df.loc[:,columns]
+
+def _split_intervals(intervals):
+    """
+    Chromosome, start and end columns of a BED3-like table. A 
+    DataFrame uses its chr/start/end columns when present, otherwise 
+    its first three. Two-column inputs are (start, end) pairs on a 
+    single unnamed chromosome.
+    """
+    if isinstance(intervals, pd.DataFrame):
+        if all([ col in intervals.columns for col in ('chr','start','end') ]):
+            intervals = intervals.loc[:,('chr','start','end')]
+        intervals = intervals.iloc[:,:3].values
+    intervals = np.asarray(intervals)
+    if intervals.ndim == 1:
+        intervals = intervals.reshape(1,-1)
+    if intervals.shape[1] == 2:
+        chroms = np.zeros(intervals.shape[0], dtype=np.int64)
+        return chroms, intervals[:,0].astype(np.int64), intervals[:,1].astype(np.int64)
+    return intervals[:,0], intervals[:,1].astype(np.int64), intervals[:,2].astype(np.int64)
+
+class IntervalIndex(object):
+    """
+    Per-chromosome index over BED3 rows (chr, start, end) for batch 
+    overlap queries. Rows are kept sorted by start (and separately by 
+    end), so a query costs O(log N) to count and O(log N + hits) to 
+    list, with candidates bounded by the longest row.
+    
+    Overlap follows check_overlap_bed: a query overlaps a row on the 
+    same chromosome when the later-starting of the two begins before 
+    the other ends. Rows are assumed to have start <= end.
+    """
+    def __init__(self, intervals):
+        chroms, starts, ends = _split_intervals(intervals)
+        self.n_rows = starts.shape[0]
+        self.chroms = OrderedDict()
+        if self.n_rows == 0:
+            return None
+        codes, uniques = pd.factorize(chroms)
+        for code, chrom in enumerate(uniques):
+            rows = np.nonzero(codes == code)[0]
+            rows = rows[ np.argsort(starts[rows], kind='stable') ]
+            self.chroms[chrom] = ( rows, starts[rows], ends[rows], 
+                                   np.sort(ends[rows]), (ends[rows] - starts[rows]).max() )
+    
+    def _by_chrom(self, intervals):
+        chroms, starts, ends = _split_intervals(intervals)
+        if starts.shape[0] == 0:
+            return None
+        codes, uniques = pd.factorize(chroms)
+        for code, chrom in enumerate(uniques):
+            if chrom not in self.chroms:
+                continue
+            query = np.nonzero(codes == code)[0]
+            yield query, starts[query], ends[query], self.chroms[chrom]
+    
+    def count(self, intervals):
+        """
+        Number of indexed rows overlapping each query interval.
+        """
+        counts = np.zeros(_split_intervals(intervals)[1].shape[0], dtype=np.int64)
+        for query, q_start, q_end, (rows, starts, ends, sorted_ends, max_len) in self._by_chrom(intervals):
+            ## Rows starting at or before the query start that reach past it
+            counts[query] = np.searchsorted(starts, q_start, side='right') - \
+                            np.searchsorted(sorted_ends, q_start, side='right')
+            ## Rows starting strictly inside the query
+            counts[query]+= np.maximum(np.searchsorted(starts, q_end, side='left') - 
+                                       np.searchsorted(starts, q_start, side='right'), 0)
+        return counts
+    
+    def query(self, intervals):
+        """
+        All overlapping (query, row) pairs as positional indices into 
+        the query intervals and the indexed rows, sorted by query, 
+        then row.
+        """
+        hold_query = []
+        hold_row   = []
+        for query, q_start, q_end, (rows, starts, ends, sorted_ends, max_len) in self._by_chrom(intervals):
+            lo = np.searchsorted(starts, q_start - max_len, side='right')
+            hi = np.searchsorted(starts, np.maximum(q_end, q_start + 1), side='left')
+            counts = np.maximum(hi - lo, 0)
+            ## Expand candidate ranges, then drop rows ending before the query
+            q_rep  = np.repeat(np.arange(query.shape[0]), counts)
+            cands  = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            hits   = ends[cands] > q_start[q_rep]
+            hold_query.append( query[q_rep[hits]] )
+            hold_row.append( rows[cands[hits]] )
+        if len(hold_query) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        query_pairs = np.concatenate(hold_query)
+        row_pairs   = np.concatenate(hold_row)
+        order = np.lexsort((row_pairs, query_pairs))
+        return query_pairs[order], row_pairs[order]
+    
+    def overlaps(self, interval):
+        """
+        Boolean mask over the indexed rows overlapping one interval.
+        """
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[ self.query(interval)[1] ] = True
+        return mask
 
 def check_overlap(interval, array):
-    height = array.shape[0]
-    intervals = np.stack([np.tile(interval,(height,1)), array],axis=0)
-    anchor =  (intervals[0,:,0] < intervals[1,:,0]).astype(int)
-    return intervals[1-anchor,np.arange(height),1] > intervals[anchor,np.arange(height),0]
+    return IntervalIndex(array).overlaps(interval)
 
 def check_overlap_bed(interval, array):
-    height = array.shape[0]
-    intervals= np.stack([np.tile(interval,(height,1)), array],axis=0)
-    intervals[:,:,1:3] = intervals[:,:,1:3].astype(int)
-    swaghook = (intervals[0,:,1] < intervals[1,:,1]).astype(int)
-    chrom    = (intervals[0,:,0] == intervals[1,:,0])
-    overlap  = intervals[1-swaghook,np.arange(height),2] > intervals[swaghook,np.arange(height),1]
-    return overlap & chrom
+    return IntervalIndex(array).overlaps(interval)
+
+def get_sliding_windows(pos_array, window_size, step_size):
+    """
+    Sliding windows over each chromosome's span of pos_array rows 
+    (chrom, start, end), keeping windows that overlap at least one row. 
+    Occupancy comes from range counts on sorted starts and ends, so 
+    the cost is O((N+W) log N) instead of a scan per window.
+    """
+    hold_ = []
+    for chrom in np.unique(pos_array[:,0]):
+        on_chr = pos_array[ pos_array[:,0] == chrom ]
+        lims   = (on_chr[:,1].min(), on_chr[:,2].max())
+        starts = np.arange(*lims, step_size)
+        ends   = np.minimum(starts + window_size, lims[1])
+        occupancy = np.searchsorted(np.sort(on_chr[:,1]), ends, side='left') - \
+                    np.searchsorted(np.sort(on_chr[:,2]), starts, side='right')
+        keep   = occupancy > 0
+        hold_.append( np.stack([np.full(keep.sum(), chrom), starts[keep], ends[keep]], axis=1) )
+    return np.concatenate(hold_, axis=0)
+
+def get_window_overlaps(pos_array, windows):
+    """
+    All overlapping (window, row) pairs between windows and pos_array, 
+    both as (chrom, start, end) arrays. Windows on each chromosome are 
+    located with searchsorted on sorted window starts, bounded by the 
+    longest window, so each row costs O(log W + overlap). A zero-length 
+    row (start == end, as with --no_offsets) overlaps the window holding 
+    its position, start <= position < end. Pairs are returned sorted by 
+    window, then row.
+    """
+    hold_win = []
+    hold_row = []
+    for chrom in np.unique(windows[:,0]):
+        win_idx = np.nonzero(windows[:,0] == chrom)[0]
+        row_idx = np.nonzero(pos_array[:,0] == chrom)[0]
+        if row_idx.shape[0] == 0:
+            continue
+        win_idx = win_idx[ np.argsort(windows[win_idx,1], kind='stable') ]
+        w_start = windows[win_idx,1].astype(np.int64)
+        w_end   = windows[win_idx,2].astype(np.int64)
+        r_start = pos_array[row_idx,1].astype(np.int64)
+        r_end   = pos_array[row_idx,2].astype(np.int64)
+        max_len = (w_end - w_start).max()
+        lo = np.searchsorted(w_start, r_start - max_len, side='right')
+        hi = np.searchsorted(w_start, np.maximum(r_end, r_start + 1), side='left')
+        counts = np.maximum(hi - lo, 0)
+        ## Expand candidate ranges, then drop windows ending before the row
+        rows   = np.repeat(np.arange(row_idx.shape[0]), counts)
+        cands  = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        hits   = w_end[cands] > r_start[rows]
+        hold_win.append( win_idx[cands[hits]] )
+        hold_row.append( row_idx[rows[hits]] )
+    if len(hold_win) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    win_pairs = np.concatenate(hold_win)
+    row_pairs = np.concatenate(hold_row)
+    order = np.lexsort((row_pairs, win_pairs))
+    return win_pairs[order], row_pairs[order]
+
+def _expand_ranges(lo, hi):
+    """
+    Flatten the half-open ranges [lo, hi) into (owner, index) pairs.
+    """
+    counts = np.maximum(hi - lo, 0)
+    owner  = np.repeat(np.arange(lo.shape[0]), counts)
+    index  = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    return owner, index
 
 def intersect_bed3(array1, array2):
-    output = []
-    uniq_chr = [ x for x in np.unique(array1[:,0]) if x in np.unique(array2[:,0]) ]
-    for on_chr in uniq_chr:
-        if sum(array1[:,0] == on_chr) >= sum(array2[:,0] == on_chr):
-            longer = array1[ array1[:,0] == on_chr ]
-            shorter= array2[ array2[:,0] == on_chr ]
+    """
+    Pairwise intersections of two (chr, start, end) arrays, where rows 
+    overlap when a.start < b.end and a.end >= b.start. On each 
+    chromosome the larger set is the "longer" one and rows come out 
+    in (shorter, longer) start-sorted order. Pairs are found by a 
+    sweep over sorted starts: those where the longer row starts inside 
+    the shorter row, and those where the shorter row starts inside the 
+    longer row, each a contiguous searchsorted range. The cost is 
+    O((n + m) log(n + m) + hits) instead of a scan per row. Assumes 
+    rows have end >= start.
+    """
+    codes1, chroms1 = pd.factorize(array1[:,0], sort=True)
+    codes2, chroms2 = pd.factorize(array2[:,0], sort=True)
+    lookup2  = { chrom: code for code, chrom in enumerate(chroms2) }
+    rows1    = np.split(np.argsort(codes1, kind='stable'), np.cumsum(np.bincount(codes1, minlength=len(chroms1)))[:-1])
+    rows2    = np.split(np.argsort(codes2, kind='stable'), np.cumsum(np.bincount(codes2, minlength=len(chroms2)))[:-1])
+    hold_chr, hold_left, hold_right = [], [], []
+    for code1, on_chr in enumerate(chroms1):
+        if on_chr not in lookup2:
+            continue
+        sub1 = array1[ rows1[code1] ]
+        sub2 = array2[ rows2[lookup2[on_chr]] ]
+        if sub1.shape[0] >= sub2.shape[0]:
+            longer, shorter = sub1, sub2
         else:
-            longer = array2[ array2[:,0] == on_chr ]
-            shorter= array1[ array1[:,0] == on_chr ]
-            
+            longer, shorter = sub2, sub1
         longer =  longer[  longer[:,1].argsort() ]
         shorter= shorter[ shorter[:,1].argsort() ]
-        for i in range(shorter.shape[0]):
-            left_check = shorter[i,1] < longer[:,2]
-            right_check= shorter[i,2] >=longer[:,1]
-            overlap = longer[ left_check & right_check ]
-            for j in range(overlap.shape[0]):
-                left = max(shorter[i,1],overlap[j,1])
-                right= min(shorter[i,2],overlap[j,2])
-                output.append([shorter[i,0],left,right])
-    return pd.DataFrame(output,columns=['chr','start','end'])
-
-def get_replicating_peaks(bed_df, use_singletons=False):
-    uniq_assays = list(bed_df['assay'].unique())
-    assay_reps  = [ bed_df.loc[bed_df['assay'] == assay,'replicate'] \
-                      .unique() 
-                    for assay in uniq_assays ]
-    assay_count = [ len(rep_list) for rep_list in assay_reps ]
-    result_peaks= []
-    for assay, reps, count in zip(uniq_assays, assay_reps, assay_count):
-        if count == 1:
-            if use_singletons:
-                result_peaks.append( bed_df.loc[ bed_df['assay'] == assay, ('chr','start','end') ] )
-            else:
-                pass
+        ## Numeric copies of positions, object arrays search slowly
+        l_start, l_end = [ np.asarray(longer[:,k].tolist()) for k in (1,2) ]
+        s_start, s_end = [ np.asarray(shorter[:,k].tolist()) for k in (1,2) ]
+        ## Longer rows starting inside a shorter row: s.start < l.start <= s.end
+        s_idx_a, l_idx_a = _expand_ranges(np.searchsorted(l_start, s_start, side='right'), 
+                                          np.searchsorted(l_start, s_end, side='right'))
+        ## Shorter rows starting inside a longer row: l.start <= s.start < l.end
+        l_idx_b, s_idx_b = _expand_ranges(np.searchsorted(s_start, l_start, side='left'), 
+                                          np.searchsorted(s_start, l_end, side='left'))
+        s_idx = np.concatenate([s_idx_a, s_idx_b])
+        l_idx = np.concatenate([l_idx_a, l_idx_b])
+        keep  = (s_start[s_idx] < l_end[l_idx]) & (s_end[s_idx] >= l_start[l_idx])
+        order = np.lexsort((l_idx[keep], s_idx[keep]))
+        s_idx, l_idx = s_idx[keep][order], l_idx[keep][order]
+        hold_chr.append( shorter[s_idx,0] )
+        hold_left.append( np.maximum(s_start[s_idx], l_start[l_idx]) )
+        hold_right.append( np.minimum(s_end[s_idx], l_end[l_idx]) )
+    if sum([ x.shape[0] for x in hold_chr ]) == 0:
+        return pd.DataFrame([],columns=['chr','start','end'])
+    return pd.DataFrame({'chr': np.concatenate(hold_chr), 
+                         'start': np.concatenate(hold_left), 
+                         'end': np.concatenate(hold_right)}).infer_objects()
+
+def get_replicating_peaks(bed_df, use_singletons=False, min_replicates=2, return_depth=False):
+    """
+    Peaks supported by replicate experiments of each assay, merged 
+    across assays. Each replicate's peaks are merged first. Strictly 
+    overlapping replicate peaks of one assay then form a cluster, and 
+    a cluster is kept when at least min_replicates replicates cover 
+    one of its positions at the same time. Single-replicate assays 
+    contribute their peaks only with use_singletons.
+    
+    All assays are handled together: merges are keyed on 
+    (assay, replicate, chr) and (assay, chr), and replicate depth comes 
+    from one sorted stream of start (+1) and end (-1) events per 
+    cluster. With return_depth, a `depth` column gives the highest 
+    replicate depth in each region (1 for singleton peaks).
+    """
+    assert min_replicates >= 1, "Peaks need at least one replicate."
+    columns = ['chr','start','end','depth'] if return_depth else ['chr','start','end']
+    if bed_df.shape[0] == 0:
+        return pd.DataFrame(columns=columns)
+    assay_code, assays = pd.factorize(bed_df['assay'])
+    rep_code,   reps   = pd.factorize(bed_df['replicate'])
+    chrom_code, chroms = pd.factorize(bed_df['chr'], sort=True)
+    n_reps   = pd.Series(rep_code).groupby(assay_code).nunique().reindex(np.arange(len(assays))).values
+    n_chrom  = len(chroms)
+    positions= bed_df.loc[:,('start','end')].values
+    ## Merge each replicate's own peaks
+    rep_key  = (assay_code.astype(np.int64) * len(reps) + rep_code) * n_chrom + chrom_code
+    order, group_start = _merge_keyed(rep_key, positions[:,0], positions[:,1], 0)
+    rep_pos, _ = _merge_groups(positions[order], group_start)
+    rep_key  = rep_key[order][group_start]
+    ## Cluster strictly overlapping replicate peaks within each assay
+    clu_key  = (rep_key // n_chrom // len(reps)) * n_chrom + rep_key % n_chrom
+    order, clu_start = _merge_keyed(clu_key, rep_pos[:,0], rep_pos[:,1], 1)
+    clu_pos, _ = _merge_groups(rep_pos[order], clu_start)
+    clu_key  = clu_key[order][clu_start]
+    member   = np.repeat(np.arange(clu_start.shape[0]), np.diff(np.append(clu_start, order.shape[0])))
+    ## Replicate depth: running sum of events, ends before starts at a shared position
+    ev_clu   = np.concatenate([member, member])
+    ev_pos   = np.concatenate([rep_pos[order,0], rep_pos[order,1]])
+    ev_step  = np.concatenate([np.ones(order.shape[0], dtype=np.int64), -np.ones(order.shape[0], dtype=np.int64)])
+    ev_order = np.lexsort((ev_step, ev_pos, ev_clu))
+    depth    = np.maximum.reduceat(np.cumsum(ev_step[ev_order]), 
+                                   np.searchsorted(ev_clu[ev_order], np.arange(clu_start.shape[0])))
+    clu_reps = n_reps[ clu_key // n_chrom ]
+    keep     = ((clu_reps > 1) & (depth >= min_replicates)) | ((clu_reps == 1) & use_singletons)
+    if keep.sum() == 0:
+        return pd.DataFrame(columns=columns)
+    ## Merge supported regions across assays
+    keep_chrom = clu_key[keep] % n_chrom
+    order, group_start = _merge_keyed(keep_chrom, clu_pos[keep,0], clu_pos[keep,1], 0)
+    merged_pos, _ = _merge_groups(clu_pos[keep][order], group_start)
+    result = pd.DataFrame({'chr': np.asarray(chroms)[ keep_chrom[order][group_start] ], 
+                           'start': merged_pos[:,0], 
+                           'end': merged_pos[:,1], 
+                           'depth': np.maximum.reduceat(depth[keep][order], group_start)})
+    return result.loc[:,columns]
+
+class GuideCoverage(object):
+    """
+    Guide target-area coverage, built once from guide Coordinates (or a 
+    parse_guide_coords table) and reused across peak sets. Target areas 
+    are held in an IntervalIndex, so coverage for an array of peaks is 
+    two searchsorted calls on per-chromosome cumulative start and end 
+    counts.
+    """
+    def __init__(self, guide_coords, plus_offsets=[152, 147], minus_offsets=[146, 153]):
+        if isinstance(guide_coords, pd.DataFrame) and 'target_start' in guide_coords.columns:
+            guides = guide_coords
         else:
-            in_assay = []
-            assay_sub= bed_df[ bed_df['assay'] == assay ]
-            for rep in reps:
-                in_rep   = assay_sub[ assay_sub['replicate'] == rep ]
-                rep_merge= merge_bed(in_rep)
-                in_assay.append( rep_merge )
-            assay_merge = pd.concat(in_assay, axis=0).reset_index(drop=True)
-            assay_merge = merge_bed( assay_merge, count=True, req_overlap=True )
-            result_peaks.append( assay_merge.loc[ assay_merge['count'] > 1, ('chr','start','end') ] )
-    return merge_bed(pd.concat( result_peaks, axis=0 ).reset_index(drop=True))
+            guides = parse_guide_coords(guide_coords, plus_offsets, minus_offsets)
+        guides = guides[ guides['chrom'].notnull().values ]
+        self.n_guides = guides.shape[0]
+        self.index = IntervalIndex(pd.DataFrame({'chr': guides['chrom'].astype(object).values, 
+                                                 'start': guides['target_start'].values.astype(np.int64), 
+                                                 'end': guides['target_end'].values.astype(np.int64)}))
+    
+    def count(self, intervals):
+        """
+        Number of guide target areas overlapping each (chr, start, end) row.
+        """
+        return self.index.count(intervals)
+    
+    def profile(self, chrom, start, end):
+        """
+        Per-bp number of guide target areas covering [start, end) on chrom.
+        """
+        positions = np.arange(start, end)
+        return self.count(np.stack([np.full(positions.shape[0], chrom, dtype=object), 
+                                    positions, positions + 1], axis=1))
+    
+    def passes(self, bed_df, min_coverage=30, min_unit_coverage=None, min_unit_size=100):
+        """
+        Coverage of each peak and whether it clears min_coverage, or 
+        min_unit_coverage guides per min_unit_size bp when given.
+        """
+        coverage = self.count(bed_df.iloc[:,:3].values)
+        if min_unit_coverage is not None:
+            n_units = (bed_df['end'].values - bed_df['start'].values) / min_unit_size
+            return coverage > (n_units * min_unit_coverage), coverage
+        return coverage > min_coverage, coverage
 
 def filter_by_guide_coverage(bed_df, guide_coords, min_coverage=30, 
                              min_unit_coverage=None, min_unit_size=100, **kwargs):
-    targeting_guides = [ x for x in guide_coords if 'chr' in x ]
-    guide_windows = guide_coords_to_target_area(targeting_guides, **kwargs)
-    out_df = []
-    for i, a_peak in bed_df.iterrows():
-        peak_as_list = list( a_peak.values )
-        peak_overlaps= check_overlap_bed( peak_as_list[:3], guide_windows.values ).sum()
-        if min_unit_coverage is not None:
-            total_len = a_peak['end'] - a_peak['start']
-            n_units   = total_len / min_unit_size
-            if peak_overlaps > (n_units * min_unit_coverage):
-                out_df.append(peak_as_list+[peak_overlaps])
-        elif peak_overlaps > min_coverage:
-            out_df.append(peak_as_list+[peak_overlaps])
-            
-    out_df = pd.DataFrame(out_df, columns=list(bed_df.columns)+['guide_coverage'])
-    return out_df
+    if isinstance(guide_coords, GuideCoverage):
+        guide_coverage = guide_coords
+    else:
+        guide_coverage = GuideCoverage([ x for x in guide_coords if 'chr' in x ], **kwargs)
+    keep, coverage = guide_coverage.passes(bed_df, min_coverage, min_unit_coverage, min_unit_size)
+    out_df = bed_df[ keep ].copy()
+    out_df['guide_coverage'] = coverage[keep]
+    return out_df.reset_index(drop=True)
 
 def extract_txn_starts(gff_df):
     txn_starts_dict = {}
@@ -145,13 +428,14 @@ def write_interact_format(pack_peaks, pack_scores, pack_TSStuple, target_path, e
         print("\t".join(header),file=f)
         for my_peaks, my_scores, my_TSStuple in zip(pack_peaks, pack_scores, pack_TSStuple):
             tss_id, tss_chr, tss_nt = my_TSStuple
-            for a_row in my_peaks.iterrows():
+            peak_hit, score_hit = IntervalIndex(my_scores).query(my_peaks.iloc[:,:3].values)
+            hit_bounds = np.searchsorted(peak_hit, np.arange(my_peaks.shape[0]+1))
+            for k, a_row in enumerate(my_peaks.iterrows()):
                 a_peak = a_row[1]
                 full_tag  = "e{}:{}/{}/{}".format(tss_id,a_row[0],tss_id,ex_tag)
                 assemble_ = [a_peak['chr'],a_peak['start'],a_peak['end']]
-                hits = check_overlap_bed(a_peak.values,
-                                         my_scores.loc[:,('chr','start','end')].values)
-                grab_scores = my_scores.loc[hits,'score'].values
+                hits = score_hit[ hit_bounds[k]:hit_bounds[k+1] ]
+                grab_scores = my_scores['score'].values[hits]
                 summit = np.argmax(np.abs(grab_scores))
                 peak_score  = grab_scores[summit]
                 assemble_.append(full_tag)               # string name
@@ -176,15 +460,16 @@ def write_bed_format(pack_peaks, pack_scores, pack_TSStuple, target_path, ex_tag
     with open(target_path,'w') as f:
         for my_peaks, my_scores, my_TSStuple in zip(pack_peaks, pack_scores, pack_TSStuple):
             tss_id, tss_chr, tss_nt = my_TSStuple
-            for a_row in my_peaks.iterrows():
+            peak_hit, score_hit = IntervalIndex(my_scores).query(my_peaks.iloc[:,:3].values)
+            hit_bounds = np.searchsorted(peak_hit, np.arange(my_peaks.shape[0]+1))
+            for k, a_row in enumerate(my_peaks.iterrows()):
                 a_peak = a_row[1]
                 full_tag  = "e{}:{}/{}/{}".format(tss_id,a_row[0],tss_id,ex_tag)
                 assemble_ = [a_peak['chr'],a_peak['start'],a_peak['end']]
-                hits = check_overlap_bed(a_peak.values,
-                                         my_scores.loc[:,('chr','start','end')].values)
-                grab_scores = my_scores.loc[hits,'score'].values
-                grab_pass   = my_scores.loc[hits,'pass']
-                grab_sign   = my_scores.loc[hits,'sign']
+                hits = score_hit[ hit_bounds[k]:hit_bounds[k+1] ]
+                grab_scores = my_scores['score'].values[hits]
+                grab_pass   = my_scores['pass'].values[hits]
+                grab_sign   = my_scores['sign'].values[hits]
                 conflict    = sum([ int(y) if x else 0 for x,y in zip(grab_pass,grab_sign) ]) != grab_pass.sum()
                 summit = np.argmax(np.abs(grab_scores))
                 peak_score  = grab_scores[summit]
@@ -195,13 +480,78 @@ def write_bed_format(pack_peaks, pack_scores, pack_TSStuple, target_path, ex_tag
                     print("\t".join(6*['{}']).format(*assemble_),file=f)
     return None
 
+GUIDE_TARGETING = 0
+GUIDE_CONTROL   = 1
+GUIDE_FILLER    = 2
+
+def parse_guide_coords(coord_array, plus_offsets=[152, 147], minus_offsets=[146, 153]):
+    """
+    Parse guide Coordinates (chr:start-end:strand) into a compact table, 
+    one row per guide in input order (keeping the index of a Series 
+    input). Strings are scanned once for their class, and coordinates 
+    are split by pandas' C CSV reader rather than per-guide in Python.
+
+    Inputs
+    ----------
+    coord_array: array-like
+        Guide Coordinates strings, controls and fillers included.
+    plus_offsets, minus_offsets: list
+        Distance upstream and downstream of the guide end coordinate 
+        covered by CRISPR activity, for + and - strand guides.
+
+    Returns
+    ----------
+    guides: DataFrame
+        chrom (categorical, sorted categories), start, end, cutsite 
+        (int32), strand (int8, 1 or -1), guide_class (int8: GUIDE_CONTROL 
+        for NT and CTRL guides, GUIDE_FILLER for FILLER-LV2 and 
+        FILLER-SgO guides, GUIDE_TARGETING otherwise) and target_start, 
+        target_end (int32), the offset-adjusted area of activity. Guides 
+        without coordinates get a missing chrom, strand 0 and positions 
+        of -1.
+    """
+    coords = [ str(coord) for coord in coord_array ]
+    n_guide= len(coords)
+    guide_class = np.array([ GUIDE_CONTROL if ('NT' in coord or 'CTRL' in coord) else 
+                             GUIDE_FILLER if ('FILLER-LV2' in coord or 'FILLER-SgO' in coord) else 
+                             GUIDE_TARGETING for coord in coords ], dtype=np.int8).reshape(-1)
+    genomic = np.array([ ':' in coord for coord in coords ], dtype=bool).reshape(-1)
+    genomic&= guide_class == GUIDE_TARGETING
+    chrom   = pd.Categorical([None] * n_guide, categories=[])
+    start   = np.full(n_guide, -1, dtype=np.int64)
+    end     = np.full(n_guide, -1, dtype=np.int64)
+    plus    = np.zeros(n_guide, dtype=bool)
+    if genomic.any():
+        ## chr:start-end:+ becomes 4 tab separated fields, chr:start-end:- becomes 5
+        text  = '\n'.join([ coord for coord, keep in zip(coords, genomic) if keep ])
+        table = pd.read_csv(io.StringIO(text.translate(str.maketrans(':-', '\t\t'))), sep='\t', 
+                            header=None, names=['chrom','start','end','strand','minus'], usecols=[0,1,2,3], 
+                            dtype={'chrom': 'category', 'start': np.int64, 'end': np.int64, 'strand': 'category'}, 
+                            engine='c')
+        found = table['chrom'].cat.categories.astype(str)
+        codes = np.full(n_guide, -1, dtype=np.int32)
+        codes[genomic] = table['chrom'].cat.set_categories(sorted(found)).cat.codes.values
+        chrom = pd.Categorical.from_codes(codes, categories=sorted(found))
+        start[genomic] = table['start'].values
+        end[genomic]   = table['end'].values
+        plus[genomic]  = (table['strand'] == '+').values
+    guides = pd.DataFrame({'chrom': chrom, 
+                           'start': start, 
+                           'end': end, 
+                           'cutsite': np.where(genomic, np.where(plus, end - 4, start + 3), -1), 
+                           'strand': np.where(genomic, np.where(plus, 1, -1), 0), 
+                           'guide_class': guide_class, 
+                           'target_start': np.where(genomic, end - np.where(plus, plus_offsets[0], minus_offsets[0]), -1), 
+                           'target_end': np.where(genomic, end + np.where(plus, plus_offsets[1], minus_offsets[1]), -1)})
+    guides = guides.astype({'start': np.int32, 'end': np.int32, 'cutsite': np.int32, 'strand': np.int8, 
+                            'target_start': np.int32, 'target_end': np.int32})
+    if isinstance(coord_array, (pd.Series, pd.Index)):
+        guides.index = coord_array if isinstance(coord_array, pd.Index) else coord_array.index
+    return guides
+
 def guide_coords_to_target_area(coord_array, plus_offsets = [152, 147], minus_offsets= [146, 153]):
-    pos_array = [ ( coord.split(':')[0],
-                    int(coord.split(':')[1].split('-')[1]) - plus_offsets[0],
-                    int(coord.split(':')[1].split('-')[1]) + plus_offsets[1] ) if coord.split(':')[2] == '+' 
-                  else ( coord.split(':')[0],
-                         int(coord.split(':')[1].split('-')[1]) - minus_offsets[0],
-                         int(coord.split(':')[1].split('-')[1]) + minus_offsets[1] )
-                  for coord in coord_array ]
-    pos_array = pd.DataFrame(pos_array, columns=['chr','start','end'])
+    guides = parse_guide_coords(coord_array, plus_offsets, minus_offsets)
+    pos_array = pd.DataFrame({'chr': guides['chrom'].astype(object).values, 
+                              'start': guides['target_start'].values.astype(np.int64), 
+                              'end': guides['target_end'].values.astype(np.int64)})
     return pos_array
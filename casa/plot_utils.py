@@ -97,11 +97,7 @@ def plot_hff_cutsites(plot_interval, cutsite_data, peak_data, plot_ids, get_chro
     # Subset cutsite scores
     plot_id_slicer = [an_id for an_id in plot_ids if an_id in cutsite_data.columns]
     sub_cuts = cutsite_data.loc[:,plot_id_slicer]
-    sub_cuts['cutsite'] = [ int(coord.split(':')[1].split('-')[1]) - 4 
-                            if coord.split(':')[-1] == '+' 
-                            else 
-                            int(coord.split(':')[1].split('-')[0]) + 3 
-                            for coord in sub_cuts.index ]
+    sub_cuts['cutsite'] = parse_guide_coords(sub_cuts.index)['cutsite'].values.astype(np.int64)
     slice_cuts = check_overlap(plot_interval,np.vstack([cutsite_data['cutsite'].values, 
                                                        (cutsite_data['cutsite']+1).values]).T)
     sub_cuts = sub_cuts.loc[slice_cuts, :]
@@ -162,11 +158,7 @@ def plot_combined_cutsites(plot_interval, cutsite_data, peak_data, plot_ids, mer
     # Subset cutsite scores
     plot_id_slicer = [an_id for an_id in plot_ids if an_id in cutsite_data.columns]
     sub_cuts = cutsite_data.loc[:,plot_id_slicer]
-    sub_cuts['cutsite'] = [ int(coord.split(':')[1].split('-')[1]) - 4 
-                            if coord.split(':')[-1] == '+' 
-                            else 
-                            int(coord.split(':')[1].split('-')[0]) + 3 
-                            for coord in sub_cuts.index ]
+    sub_cuts['cutsite'] = parse_guide_coords(sub_cuts.index)['cutsite'].values.astype(np.int64)
     slice_cuts = check_overlap(plot_interval,np.vstack([cutsite_data['cutsite'].values, 
                                                        (cutsite_data['cutsite']+1).values]).T)
     sub_cuts = sub_cuts.loc[slice_cuts, :]
@@ -266,7 +258,11 @@ def draw_bed_blocks(ax, bed, ylims=[1.25,1.75]):
 def connect_bed_to_genes(ax, bed, target_tuple, y_anchor=1.25, y_target=1.0, score_bed=None, xlims=None):
     gene_chrom  = target_tuple[0]
     gene_target = target_tuple[1]
-    for i, line in bed.iterrows():
+    if score_bed is not None:
+        bed_hit, score_hit = IntervalIndex(score_bed.loc[:,('start','end')].values) \
+                               .query(bed.loc[:,('start','end')].values.astype(int))
+        hit_bounds = np.searchsorted(bed_hit, np.arange(bed.shape[0]+1))
+    for k, (i, line) in enumerate(bed.iterrows()):
         start = int(line['start'])
         end   = int(line['end'])
 
@@ -276,8 +272,7 @@ def connect_bed_to_genes(ax, bed, target_tuple, y_anchor=1.25, y_target=1.0, sco
         else:
             midpt = score_bed['score'].median()
             cap   = max(np.abs(score_bed['score'] - midpt))
-            slicer= check_overlap([start,end],score_bed.loc[:,('start','end')].values)
-            ovl   = score_bed[ slicer ]
+            ovl   = score_bed.iloc[ score_hit[ hit_bounds[k]:hit_bounds[k+1] ] ]
             best  = ovl.iloc[ (ovl['score'] - midpt).abs().values.argmax() ]['score']
             if ovl['pass'].sum() > 0:
                 alph = np.abs(best-midpt) / cap
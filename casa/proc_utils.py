@@ -0,0 +1,29 @@
+import resource
+
+def reset_peak_rss():
+    ## Linux only: writing 5 to clear_refs restarts VmHWM
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+def peak_rss(pid='self'):
+    """
+    Peak resident set size in MB of this process, or of another live 
+    process given its pid, since the last reset_peak_rss() where 
+    supported, otherwise since it started. Chains run in child 
+    processes are not included. For another process, returns None 
+    if its status can't be read (e.g. it already exited).
+    """
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, OSError):
+        pass
+    if pid != 'self':
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
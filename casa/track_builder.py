@@ -4,68 +4,190 @@ import os
 import glob
 import csv
 import argparse
+import multiprocessing
 
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+from genome_utils import parse_guide_coords, merge_bed, IntervalIndex
+from track_format import TrackWriter
+
 if os.environ.get('DISPLAY') is None:
     plt.switch_backend('agg')
 
 def get_args():    
     parser = argparse.ArgumentParser(description='Summarize CRISPRi screen guide-wise data as a signal track.')
-    parser.add_argument('guide_data',help='Input flow-fish guide count data.')
-    parser.add_argument('output_file',help='Output file to print track to.')
+    parser.add_argument('guide_data',nargs='+',help='Input flow-fish guide count data. Several files sharing one guide '+\
+                                                    'library are segmented once and written as a sample matrix.')
+    parser.add_argument('output_file',help='Output file to print track to. Used as a file name prefix with '+\
+                                           '`--sample_output bedgraph`.')
     parser.add_argument('--summ_plot_tag','-p',type=str,help='File name prefix for data histograms.')
     parser.add_argument('--verbose','-v',action='store_true',help='Print stuff to screen to help with debugging and stuff.')
     parser.add_argument('--median_shift','-m',action='store_true',help='Zero the median of guide-wise scores.')
+    parser.add_argument('--workers','-w',type=int,default=1,help='Worker processes building chromosomes or regions concurrently.')
+    parser.add_argument('--regions','-r',type=str,default=None,help='BED file of regions to build tracks over. '+\
+                                                                    'Overlapping regions are merged. Default: every chromosome.')
+    parser.add_argument('--sample_output','-so',type=str,default='matrix',choices=['matrix','bedgraph'],
+                        help='With several guide_data files, write one segments x samples score matrix '+\
+                             'or one bedGraph per sample.')
+    parser.add_argument('--sample_names','-sn',type=str,default=None,
+                        help='Comma separated sample names for several guide_data files. Default: file names.')
+    parser.add_argument('--output_format','-of',type=str,default='tsv',choices=['tsv','binary'],
+                        help='Write a tab separated track, or an indexed binary track with zoom levels '+\
+                             'for region queries (see track_format.TrackReader).')
     args = parser.parse_args()
     return args
 
-def merge_intervals(intervals, count=False):
-    sorted_intervals = intervals[ intervals[:,0].argsort() ]
-    merged_intervals = sorted_intervals[0:1]
-    counts = []
-    k = 1
-    for i in range(1,sorted_intervals.shape[0]):
-        next_interval = sorted_intervals[i:i+1]
-        last_interval = merged_intervals[-1:]
-        if next_interval[0,0] <= last_interval[0,1]:
-            new_max = max( next_interval[0,1], last_interval[0,1] )
-            merged_intervals[-1,1] = new_max
-            k += 1
-        else:
-            merged_intervals = np.concatenate([merged_intervals,next_interval], 
-                                              axis=0)
-            counts.append(k)
-            k = 1
-    if count:
-        return merged_intervals, counts
+def check_args(args):
+    assert args.workers > 0, "Need at least one worker."
+    if args.sample_names is not None:
+        assert len(args.sample_names.split(',')) == len(args.guide_data), "Need one sample name per guide_data file."
+    if args.output_format == 'binary':
+        assert args.sample_output == 'matrix', "Binary output stores several samples as a matrix, not bedGraphs."
+    return True
+
+def sweep_track(pos_array, ls_reads, hs_reads):
+    """
+    Signal track segments over guide target areas pos_array (start, end). 
+    Breakpoints are the sorted unique starts and ends. Guide counts and 
+    LS/HS read sums at each breakpoint come from cumulative sums over 
+    start- and end-sorted guides, so each segment between breakpoints 
+    costs O(log N) instead of a scan per nucleotide. Segments with no 
+    covering guides are dropped.
+    """
+    starts, ends = pos_array[:,0], pos_array[:,1]
+    start_order  = np.argsort(starts, kind='stable')
+    end_order    = np.argsort(ends, kind='stable')
+    breaks  = np.unique(pos_array)
+    n_open  = np.searchsorted(starts[start_order], breaks, side='right')
+    n_close = np.searchsorted(ends[end_order], breaks, side='right')
+    sums    = []
+    for reads in (ls_reads, hs_reads):
+        opened = np.concatenate([[0], np.cumsum(reads[start_order])])
+        closed = np.concatenate([[0], np.cumsum(reads[end_order])])
+        sums.append( (opened[n_open] - closed[n_close])[:-1] )
+    guide_count = (n_open - n_close)[:-1]
+    keep = guide_count > 0
+    ls_sum, hs_sum = sums[0][keep], sums[1][keep]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        score = np.log( ls_sum / hs_sum )
+    return pd.DataFrame({'start': breaks[:-1][keep].astype(np.int64), 
+                         'end': breaks[1:][keep].astype(np.int64), 
+                         'guide_count': guide_count[keep].astype(np.int64), 
+                         'LS_reads': ls_sum, 
+                         'HS_reads': hs_sum, 
+                         'score': score})
+
+def sweep_samples(pos_array, ls_reads, hs_reads, present):
+    """
+    sweep_track for several samples over one guide library. ls_reads, 
+    hs_reads and present are (guides, samples) arrays, present marking 
+    the guides each sample kept. Breakpoints come from the whole 
+    library once; per-sample guide counts and read sums at each 
+    breakpoint come from column-wise cumulative sums. Also flags, per 
+    sample, the segments where that sample's covering guides change.
+    """
+    starts, ends = pos_array[:,0], pos_array[:,1]
+    start_order  = np.argsort(starts, kind='stable')
+    end_order    = np.argsort(ends, kind='stable')
+    breaks  = np.unique(pos_array)
+    n_open  = np.searchsorted(starts[start_order], breaks, side='right')
+    n_close = np.searchsorted(ends[end_order], breaks, side='right')
+    def at_breaks(values):
+        pad    = np.zeros((1, values.shape[1]), dtype=values.dtype)
+        opened = np.concatenate([pad, np.cumsum(values[start_order], axis=0)])[n_open]
+        closed = np.concatenate([pad, np.cumsum(values[end_order], axis=0)])[n_close]
+        return opened, closed
+    opened, closed = at_breaks(present.astype(np.int64))
+    ## A sample's guide set changes where one of its guides starts or ends
+    change     = np.ones(opened.shape, dtype=bool)
+    change[1:] = (np.diff(opened, axis=0) + np.diff(closed, axis=0)) > 0
+    sums = []
+    for reads in (ls_reads, hs_reads):
+        opened_reads, closed_reads = at_breaks(np.where(present, reads, 0))
+        sums.append( (opened_reads - closed_reads)[:-1] )
+    any_open, any_closed = at_breaks(present.any(axis=1).astype(np.int64)[:,None])
+    return { 'start': breaks[:-1].astype(np.int64), 
+             'end': breaks[1:].astype(np.int64), 
+             'library_count': (any_open - any_closed)[:-1,0], 
+             'guide_count': (opened - closed)[:-1], 
+             'LS_reads': sums[0], 
+             'HS_reads': sums[1], 
+             'change': change[:-1] }
+
+def clip_segments(nt_data, lo, hi):
+    nt_data = nt_data[ (nt_data['end'] > lo) & (nt_data['start'] < hi) ].copy()
+    nt_data['start'] = np.maximum(nt_data['start'].values, lo)
+    nt_data['end']   = np.minimum(nt_data['end'].values, hi)
+    return nt_data
+
+def build_region(task):
+    """
+    Track segments for one chromosome, or one region of it when lo and 
+    hi are given, clipped to that region.
+    """
+    chrom, targ_data, pos_array, lo, hi, verbose = task
+    genome_lims = (np.min(pos_array), np.max(pos_array))
+    if verbose:
+        print("{}:{}-{}={}".format(chrom, genome_lims[1], genome_lims[0], genome_lims[1] - genome_lims[0]))
+    nt_data = sweep_track(pos_array, targ_data['LS_reads'].values, targ_data['HS_reads'].values)
+    if lo is not None:
+        nt_data = clip_segments(nt_data, lo, hi)
+    nt_data.insert(0, 'chr', chrom)
+    return nt_data
+
+def build_region_samples(task):
+    """
+    Sample matrix and per-sample tracks for one chromosome or region. 
+    Each sample's track joins the shared segments its guide set does 
+    not change across, so it matches a single-sample build_region.
+    """
+    chrom, pos_array, ls_reads, hs_reads, present, names, lo, hi = task
+    sweep   = sweep_samples(pos_array, ls_reads, hs_reads, present)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.log( sweep['LS_reads'] / sweep['HS_reads'] )
+    scores[ sweep['guide_count'] == 0 ] = np.nan
+    matrix  = pd.DataFrame({'chr': chrom, 
+                            'start': sweep['start'], 
+                            'end': sweep['end'], 
+                            'guide_count': sweep['library_count']})
+    for j, name in enumerate(names):
+        matrix[name] = scores[:,j]
+    matrix  = matrix[ sweep['library_count'] > 0 ]
+    tracks  = []
+    for j, name in enumerate(names):
+        kept   = np.nonzero(sweep['guide_count'][:,j] > 0)[0]
+        first  = kept[ sweep['change'][kept,j] ]
+        last   = kept[ np.append(np.nonzero(sweep['change'][kept,j])[0][1:] - 1, kept.shape[0] - 1) ] \
+                   if kept.shape[0] > 0 else kept
+        track  = pd.DataFrame({'chr': chrom, 
+                               'start': sweep['start'][first], 
+                               'end': sweep['end'][last], 
+                               'guide_count': sweep['guide_count'][first,j].astype(np.int64), 
+                               'score': scores[first,j]})
+        tracks.append( track if lo is None else clip_segments(track, lo, hi) )
+    if lo is not None:
+        matrix = clip_segments(matrix, lo, hi)
+    return matrix, tracks
+
+def run_regions(tasks, workers=1, builder=build_region):
+    """
+    Build region tracks in order, or over a process pool. Results are 
+    yielded in task order either way, so output can be streamed sorted.
+    """
+    if workers == 1:
+        for task in tasks:
+            yield builder(task)
     else:
-        return merged_intervals
-
-def merge_bed(bed_df, count=False):
-    bed_ = bed_df.sort_values(['chr','start'],axis=0) \
-                 .reset_index(drop=True)
-    chr_set = bed_['chr'].unique()
-    hold_   = []
-    for chrom in chr_set:
-        sub_bed = bed_.loc[ bed_['chr'] == chrom, ('start','end') ]
-        if count:
-            merged_pos, counts = merge_intervals(sub_bed.values, True)
-            reorg_df= pd.DataFrame({'chr': chrom, 
-                                    'start': merged_pos[:,0],
-                                    'end': merged_pos[:,1], 
-                                    'count': counts})
-        else:
-            merged_pos = merge_intervals(sub_bed.values)
-            reorg_df= pd.DataFrame({'chr': chrom, 
-                                    'start': merged_pos[:,0],
-                                    'end': merged_pos[:,1]})
-        hold_.append(reorg_df)
-    return pd.concat(hold_, axis=0)
+        pool = multiprocessing.Pool(workers)
+        try:
+            for nt_data in pool.imap(builder, tasks, chunksize=1):
+                yield nt_data
+        finally:
+            pool.close()
+            pool.join()
 
-def main(args):
-    data = pd.read_table(args.guide_data, sep='\t', header=0)
+def prepare_data(data, args, plot_tag=None):
     data.loc[data['Coordinates'].str.contains('NT'), 'Coordinates'] = 'NT'
     data.loc[data['Coordinates'].str.contains('CTRL'),'Coordinates']= 'NT'
     if args.verbose:
@@ -96,7 +218,7 @@ def main(args):
         print("Finished downsample")
         print("LS lib size: {}".format(data['LS_reads'].sum()))
         print("HS lib size: {}".format(data['HS_reads'].sum()))
-    if args.summ_plot_tag:
+    if plot_tag:
         fig, axes = plt.subplots(2,2,figsize=(15,15))
         for i, tags in enumerate(
             zip(['LS_reads','HS_reads','US_reads'],
@@ -112,7 +234,7 @@ def main(args):
             else:
                 ax.set_xlim(0,2000)
         fig.tight_layout()
-        fig.savefig("{}__sort_bin_count_hists.pdf".format(args.summ_plot_tag))
+        fig.savefig("{}__sort_bin_count_hists.pdf".format(plot_tag))
         # Activity log-odds
         data_slice_refs = [data[ 'log(LS/HS)' ], 
                            data['log(LS/HS)'][ data['Coordinates'] == 'NT' ],
@@ -131,67 +253,157 @@ def main(args):
             ax.set_xlim(-5,5)
             ax.set_title(lead_txt+stat_txt)
         fig.tight_layout()
-        fig.savefig("{}__guide_activity_hists.pdf".format(args.summ_plot_tag))
+        fig.savefig("{}__guide_activity_hists.pdf".format(plot_tag))
+    return data
+
+def get_regions(regions_file, chr_list):
+    regions = pd.read_table(regions_file, sep='\t', header=None, usecols=[0,1,2], names=['chr','start','end'])
+    return merge_bed(regions[ regions['chr'].isin(chr_list) ])
+
+def region_guides(guides, regions):
+    """
+    Positional indices of the guides whose target areas overlap each 
+    region, as (guide_hit, hit_bounds) for slicing region by region.
+    """
+    targets = guides[ guides['chrom'].notnull().values ]
+    region_hit, guide_hit = IntervalIndex(
+        pd.DataFrame({'chr': targets['chrom'].astype(object).values, 
+                      'start': targets['target_start'].values, 
+                      'end': targets['target_end'].values})
+    ).query(regions.loc[:,('chr','start','end')].values)
+    guide_hit  = np.nonzero(guides['chrom'].notnull().values)[0][guide_hit]
+    hit_bounds = np.searchsorted(region_hit, np.arange(regions.shape[0]+1))
+    return guide_hit, hit_bounds
+
+def main(args):
+    check_args(args)
+    guide_files = [args.guide_data] if isinstance(args.guide_data, str) else list(args.guide_data)
+    if len(guide_files) > 1:
+        return main_samples(guide_files, args)
+    data = prepare_data(pd.read_table(guide_files[0], sep='\t', header=0), args, args.summ_plot_tag)
     # Convert targeting data to tracks
     plus_offsets = [152, 147]
     minus_offsets= [146, 153]
-    chr_list = [ coord.split(':')[0] for coord in data['Coordinates'] if 'chr' in coord ]
-    chr_list = sorted(list(set(chr_list)))
-    chr_data = []
-    for chrom in chr_list:
-        targ_data = data[ data['Coordinates'].str.contains(chrom) ]
-        pos_array = np.array([ [ int(coord.split(':')[1].split('-')[1]) - plus_offsets[0],
-                                 int(coord.split(':')[1].split('-')[1]) + plus_offsets[1] ] if coord.split(':')[2] == '+' 
-                               else [ int(coord.split(':')[1].split('-')[1]) - minus_offsets[0],
-                                      int(coord.split(':')[1].split('-')[1]) + minus_offsets[1] ]
-                               for coord in targ_data['Coordinates'] ])
-        genome_lims = (np.min(pos_array), np.max(pos_array))
-        if args.verbose:
-            print("{}:{}-{}={}".format(chrom, genome_lims[1], genome_lims[0], genome_lims[1] - genome_lims[0]))
-        nt_data = np.zeros( shape=[0, 4] )
-        last_start = genome_lims[0]
-        last_subset= targ_data[ (pos_array[:,0] <= last_start) & (pos_array[:,1] > last_start) ]
-        ep = 1e-200
-        merged_pos = merge_intervals(pos_array)
-        for i, segment in enumerate( merged_pos ):
-            if i == (merged_pos.shape[0]-1):
-                segment[1] += 1
-            for j, nt_pos in enumerate( range(*segment) ):
-                nt_subset = targ_data[ (pos_array[:,0] <= nt_pos) & (pos_array[:,1] > nt_pos) ]
-                if not nt_subset['Coordinates'].equals(last_subset['Coordinates']):
-                    if np.sum( last_subset[ 'HS_reads' ] ) == 0 or np.sum( last_subset[ 'LS_reads' ] ) == 0:
-                        if last_subset.shape[0] >= 1:
-                            print(nt_pos)
-                            print(last_subset)
-                    if last_subset.shape[0] == 1:
-                        logit_score = np.log( np.sum(last_subset[ 'LS_reads' ]) / np.sum(last_subset[ 'HS_reads' ]) )
-                    elif last_subset.shape[0] > 1:
-                        logit_score = np.log( np.sum(last_subset[ 'LS_reads' ]) / np.sum(last_subset[ 'HS_reads' ]) )
-                    else:
-                        logit_score = np.nan
-                    new_entry = np.array([[last_start, last_nt+1, last_subset.shape[0], logit_score]])
-                    nt_data   = np.concatenate([nt_data,new_entry])
-                    last_start= nt_pos
-                last_subset = nt_subset
-                last_nt     = nt_pos
-            if args.verbose:
-                if i % 20 == 0:
-                    print("On chunk [{}/{}]".format(i,merged_pos.shape[0]))
-        nt_data = pd.DataFrame(
-            { 'chr': chrom, 
-              'start': nt_data[:,0].astype(np.int64), 
-              'end': nt_data[:,1].astype(np.int64), 
-              'guide_count': nt_data[:,2].astype(np.int64), 
-              'score': nt_data[:,3]
-            }
-        )
-        chr_data.append( nt_data )
-    all_data = pd.concat(chr_data, axis=0)
+    guides   = parse_guide_coords(data['Coordinates'], plus_offsets, minus_offsets)
+    chr_list = list(guides['chrom'].cat.remove_unused_categories().cat.categories.astype(str))
     if args.median_shift:
         norm_factor = data[ 'log(LS/HS)' ].median()
-        all_data["score"] = all_data["score"] - norm_factor
-    all_data.loc[:,('chr','start','end','guide_count','score')] \
-      .to_csv(args.output_file, sep="\t", quoting=csv.QUOTE_NONE, index=False)
+    if args.regions is None:
+        def region_tasks():
+            for chrom in chr_list:
+                on_chrom  = (guides['chrom'] == chrom).values
+                pos_array = guides.loc[ on_chrom, ('target_start','target_end') ].values.astype(np.int64)
+                yield chrom, data[ on_chrom ], pos_array, None, None, args.verbose
+    else:
+        regions = get_regions(args.regions, chr_list)
+        guide_hit, hit_bounds = region_guides(guides, regions)
+        def region_tasks():
+            for k, (i, row) in enumerate(regions.iterrows()):
+                in_region = guide_hit[ hit_bounds[k]:hit_bounds[k+1] ]
+                if in_region.shape[0] == 0:
+                    continue
+                pos_array = guides.iloc[ in_region ].loc[:,('target_start','target_end')].values.astype(np.int64)
+                yield row['chr'], data.iloc[ in_region ], pos_array, row['start'], row['end'], args.verbose
+    ## Stream each finished region to the output, in sorted order
+    if args.output_format == 'binary':
+        writer = TrackWriter(args.output_file)
+        for nt_data in run_regions(region_tasks(), args.workers):
+            if args.median_shift:
+                nt_data["score"] = nt_data["score"] - norm_factor
+            writer.add( nt_data.loc[:,('chr','start','end','guide_count','score')] )
+        writer.close()
+        return None
+    with open(args.output_file, 'w') as f:
+        header = True
+        for nt_data in run_regions(region_tasks(), args.workers):
+            if args.median_shift:
+                nt_data["score"] = nt_data["score"] - norm_factor
+            nt_data.loc[:,('chr','start','end','guide_count','score')] \
+              .to_csv(f, sep="\t", quoting=csv.QUOTE_NONE, index=False, header=header)
+            header = False
+        if header:
+            print("\t".join(['chr','start','end','guide_count','score']), file=f)
+    return None
+
+def main_samples(guide_files, args):
+    """
+    Several guide count files sharing one guide library: parse and 
+    segment the library once, then write a segments x samples score 
+    matrix or one bedGraph per sample.
+    """
+    if args.sample_names is None:
+        names = [ os.path.splitext(os.path.basename(fn))[0] for fn in guide_files ]
+    else:
+        names = args.sample_names.split(',')
+    assert len(set(names)) == len(names), "Sample names must be unique."
+    library = pd.read_table(guide_files[0], sep='\t', header=0, usecols=['Coordinates'])['Coordinates']
+    n_guide = library.shape[0]
+    ls_reads= np.zeros((n_guide, len(names)))
+    hs_reads= np.zeros((n_guide, len(names)))
+    present = np.zeros((n_guide, len(names)), dtype=bool)
+    norm_factors = []
+    for j, (fn, name) in enumerate(zip(guide_files, names)):
+        data = pd.read_table(fn, sep='\t', header=0)
+        assert data['Coordinates'].equals(library), "guide_data files must share one guide library, in the same order."
+        plot_tag = None if args.summ_plot_tag is None else "{}__{}".format(args.summ_plot_tag, name)
+        data = prepare_data(data, args, plot_tag)
+        ls_reads[data.index.values,j] = data['LS_reads'].values
+        hs_reads[data.index.values,j] = data['HS_reads'].values
+        present[data.index.values,j]  = True
+        norm_factors.append( data[ 'log(LS/HS)' ].median() if args.median_shift else 0. )
+    # Convert targeting data to tracks
+    plus_offsets = [152, 147]
+    minus_offsets= [146, 153]
+    guides   = parse_guide_coords(library, plus_offsets, minus_offsets)
+    chr_list = list(guides['chrom'].cat.remove_unused_categories().cat.categories.astype(str))
+    if args.regions is None:
+        def region_tasks():
+            for chrom in chr_list:
+                on_chrom  = (guides['chrom'] == chrom).values
+                pos_array = guides.loc[ on_chrom, ('target_start','target_end') ].values.astype(np.int64)
+                yield chrom, pos_array, ls_reads[on_chrom], hs_reads[on_chrom], present[on_chrom], names, None, None
+    else:
+        regions = get_regions(args.regions, chr_list)
+        guide_hit, hit_bounds = region_guides(guides, regions)
+        def region_tasks():
+            for k, (i, row) in enumerate(regions.iterrows()):
+                in_region = guide_hit[ hit_bounds[k]:hit_bounds[k+1] ]
+                if in_region.shape[0] == 0:
+                    continue
+                pos_array = guides.iloc[ in_region ].loc[:,('target_start','target_end')].values.astype(np.int64)
+                yield row['chr'], pos_array, ls_reads[in_region], hs_reads[in_region], present[in_region], \
+                      names, row['start'], row['end']
+    ## Stream each finished region to the outputs, in sorted order
+    if args.output_format == 'binary':
+        writer = TrackWriter(args.output_file, score_columns=names)
+        for matrix, tracks in run_regions(region_tasks(), args.workers, build_region_samples):
+            for name, norm_factor in zip(names, norm_factors):
+                matrix[name] = matrix[name] - norm_factor
+            writer.add( matrix )
+        writer.close()
+        return None
+    if args.sample_output == 'matrix':
+        outputs = [ open(args.output_file, 'w') ]
+    else:
+        outputs = [ open("{}__{}.bedGraph".format(args.output_file, name), 'w') for name in names ]
+    try:
+        header = True
+        for matrix, tracks in run_regions(region_tasks(), args.workers, build_region_samples):
+            if args.sample_output == 'matrix':
+                for name, norm_factor in zip(names, norm_factors):
+                    matrix[name] = matrix[name] - norm_factor
+                matrix.to_csv(outputs[0], sep="\t", quoting=csv.QUOTE_NONE, index=False, header=header)
+                header = False
+            else:
+                for f, track, norm_factor in zip(outputs, tracks, norm_factors):
+                    track["score"] = track["score"] - norm_factor
+                    track.loc[:,('chr','start','end','score')] \
+                      .to_csv(f, sep="\t", quoting=csv.QUOTE_NONE, index=False, header=False)
+        if args.sample_output == 'matrix' and header:
+            print("\t".join(['chr','start','end','guide_count']+names), file=outputs[0])
+    finally:
+        for f in outputs:
+            f.close()
     return None
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+import json
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+#######################################
+##
+## Indexed binary signal tracks
+##
+#######################################
+##
+## File layout, all little endian:
+##   MAGIC
+##   per chromosome, in write order, column blocks sorted by start:
+##     segments: start, end, guide_count (int64) and score (float64, n x k)
+##     each zoom level: start, end, bases (int64) and mean, min, max (float64, n x k)
+##   index: JSON with score column names and, per chromosome, the row
+##          count and byte offset of every column block
+##   index byte offset (uint64), MAGIC
+##
+## The index sits at the end so chromosomes can be written as they 
+## finish. Readers memory-map the file and binary search the start and 
+## end columns, so a region query only touches the rows it returns.
+
+MAGIC = b'CASATRK1'
+ZOOM_LEVELS = [1000, 10000, 100000]
+COLUMN_TYPES = { 'start': '<i8', 'end': '<i8', 'guide_count': '<i8', 'bases': '<i8', 
+                 'score': '<f8', 'mean': '<f8', 'min': '<f8', 'max': '<f8' }
+
+def zoom_bins(starts, ends, scores, bin_size):
+    """
+    Summarize segments into fixed bins of bin_size bp: covered bases, 
+    base-weighted mean score, and min and max score of the segments 
+    touching each bin. NaN scores are skipped. Only bins holding 
+    segments are kept.
+    """
+    if starts.shape[0] == 0:
+        empty = np.zeros((0, scores.shape[1]))
+        return OrderedDict([ ('start', starts), ('end', ends), ('bases', starts), 
+                             ('mean', empty), ('min', empty), ('max', empty) ])
+    first  = starts // bin_size
+    pieces = (ends - 1) // bin_size - first + 1
+    ## Split segments at bin edges
+    seg_idx = np.repeat(np.arange(starts.shape[0]), pieces)
+    bins    = np.repeat(first - np.cumsum(pieces) + pieces, pieces) + np.arange(pieces.sum())
+    overlap = np.minimum(ends[seg_idx], (bins + 1) * bin_size) - np.maximum(starts[seg_idx], bins * bin_size)
+    order   = np.argsort(bins, kind='stable')
+    bins, seg_idx, overlap = bins[order], seg_idx[order], overlap[order]
+    uniq_bins, bounds = np.unique(bins, return_index=True)
+    piece_scores = scores[seg_idx]
+    valid   = ~np.isnan(piece_scores)
+    weights = np.where(valid, overlap[:,None], 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.add.reduceat(np.where(valid, piece_scores, 0.) * weights, bounds, axis=0) / \
+               np.add.reduceat(weights, bounds, axis=0)
+    return OrderedDict([ ('start', uniq_bins * bin_size), 
+                         ('end', (uniq_bins + 1) * bin_size), 
+                         ('bases', np.add.reduceat(overlap, bounds)), 
+                         ('mean', mean), 
+                         ('min', np.fmin.reduceat(piece_scores, bounds, axis=0)), 
+                         ('max', np.fmax.reduceat(piece_scores, bounds, axis=0)) ])
+
+class TrackWriter(object):
+    """
+    Write track segments (chr, start, end, guide_count and score 
+    columns) chromosome by chromosome. Segments of one chromosome must 
+    arrive together and in start order, as track_builder streams them.
+    """
+    def __init__(self, path, score_columns=['score'], zoom_levels=ZOOM_LEVELS):
+        self.path = path
+        self.score_columns = list(score_columns)
+        self.zoom_levels   = list(zoom_levels)
+        self.index = { 'version': 1, 'score_columns': self.score_columns, 
+                       'zoom_levels': self.zoom_levels, 'chroms': OrderedDict() }
+        self.chrom = None
+        self.held  = []
+        self.handle= open(path, 'wb')
+        self.handle.write(MAGIC)
+    
+    def add(self, nt_data):
+        for chrom, chunk in nt_data.groupby('chr', sort=False):
+            if chrom != self.chrom:
+                self.flush()
+                assert str(chrom) not in self.index['chroms'], "Segments for {} are not contiguous.".format(chrom)
+                self.chrom = chrom
+            self.held.append( chunk )
+    
+    def write_block(self, columns):
+        block = { 'n': int(columns['start'].shape[0]) }
+        for name, values in columns.items():
+            block[name] = int(self.handle.tell())
+            self.handle.write(np.ascontiguousarray(values, dtype=COLUMN_TYPES[name]).tobytes())
+        return block
+    
+    def flush(self):
+        if self.chrom is None:
+            return None
+        segments = pd.concat(self.held, axis=0)
+        starts   = segments['start'].values.astype(np.int64)
+        ends     = segments['end'].values.astype(np.int64)
+        scores   = segments.loc[:,self.score_columns].values.astype(np.float64)
+        assert (np.diff(starts) >= 0).all(), "Segments for {} are not sorted.".format(self.chrom)
+        entry = { 'segments': self.write_block(OrderedDict([ ('start', starts), ('end', ends), 
+                                                             ('guide_count', segments['guide_count'].values), 
+                                                             ('score', scores) ])), 
+                  'zooms': OrderedDict() }
+        for bin_size in self.zoom_levels:
+            entry['zooms'][str(bin_size)] = self.write_block( zoom_bins(starts, ends, scores, bin_size) )
+        self.index['chroms'][str(self.chrom)] = entry
+        self.chrom = None
+        self.held  = []
+    
+    def close(self):
+        self.flush()
+        offset = self.handle.tell()
+        self.handle.write(json.dumps(self.index).encode('utf-8'))
+        self.handle.write(np.array([offset], dtype='<u8').tobytes())
+        self.handle.write(MAGIC)
+        self.handle.close()
+
+class TrackReader(object):
+    """
+    Memory-mapped reader for TrackWriter files. Region queries binary 
+    search one chromosome's sorted start and end columns, so only the 
+    rows overlapping the region are read from disk.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        tail = len(MAGIC) + 8
+        assert self.data[:len(MAGIC)].tobytes() == MAGIC and self.data[-len(MAGIC):].tobytes() == MAGIC, \
+          "{} is not a binary track file.".format(path)
+        offset = int(np.frombuffer(self.data[-tail:-len(MAGIC)].tobytes(), dtype='<u8')[0])
+        self.index = json.loads(self.data[offset:-tail].tobytes().decode('utf-8'), object_pairs_hook=OrderedDict)
+        self.score_columns = self.index['score_columns']
+        self.zoom_levels   = self.index['zoom_levels']
+    
+    def chroms(self):
+        return list(self.index['chroms'].keys())
+    
+    def columns(self, chrom, bin_size=None):
+        """
+        Memory-mapped column arrays for a chromosome's segments, or its 
+        zoom bins of bin_size bp.
+        """
+        if bin_size is not None:
+            assert bin_size in self.zoom_levels, "Zoom levels available: {}".format(self.zoom_levels)
+        names = ['start','end','guide_count','score'] if bin_size is None else ['start','end','bases','mean','min','max']
+        if chrom not in self.index['chroms']:
+            block = { 'n': 0 }
+        elif bin_size is None:
+            block = self.index['chroms'][chrom]['segments']
+        else:
+            block = self.index['chroms'][chrom]['zooms'][str(bin_size)]
+        columns = OrderedDict()
+        for name in names:
+            shape = (block['n'],) if COLUMN_TYPES[name] == '<i8' else (block['n'], len(self.score_columns))
+            if block['n'] == 0:
+                columns[name] = np.zeros(shape, dtype=COLUMN_TYPES[name])
+            else:
+                columns[name] = np.ndarray(shape=shape, dtype=COLUMN_TYPES[name], buffer=self.data, offset=block[name])
+        return columns
+    
+    def query(self, chrom, start, end, bin_size=None):
+        """
+        Segments (or zoom bins of bin_size bp) overlapping [start, end) 
+        on chrom, as a DataFrame.
+        """
+        columns = self.columns(chrom, bin_size)
+        lo = np.searchsorted(columns['end'], start, side='right')
+        hi = max(lo, np.searchsorted(columns['start'], end, side='left'))
+        out = pd.DataFrame({'chr': chrom, 'start': np.array(columns['start'][lo:hi]), 
+                            'end': np.array(columns['end'][lo:hi])})
+        for name, values in list(columns.items())[2:]:
+            values = np.array(values[lo:hi])
+            if values.ndim == 1:
+                out[name] = values
+            elif bin_size is None:
+                for j, col in enumerate(self.score_columns):
+                    out[col] = values[:,j]
+            else:
+                for j, col in enumerate(self.score_columns):
+                    out[name if self.score_columns == ['score'] else '{}_{}'.format(col, name)] = values[:,j]
+        return out
+    
+    def best_zoom(self, chrom, start, end, max_rows=2000):
+        """
+        Finest detail keeping a region under max_rows rows: None for 
+        raw segments, else the smallest zoom bin size that fits.
+        """
+        columns = self.columns(chrom)
+        n_rows  = np.searchsorted(columns['start'], end, side='left') - \
+                  np.searchsorted(columns['end'], start, side='right')
+        if n_rows <= max_rows:
+            return None
+        for bin_size in sorted(self.zoom_levels):
+            if (end - start) / bin_size <= max_rows:
+                return bin_size
+        return max(self.zoom_levels)
+
+def read_track_region(path, chrom, start, end, bin_size=None):
+    """
+    Track rows overlapping [start, end) on chrom from a binary track
+    file, or by filtering a TSV track from track_builder.
+    """
+    with open(path, 'rb') as f:
+        is_binary = f.read(len(MAGIC)) == MAGIC
+    if is_binary:
+        return TrackReader(path).query(chrom, start, end, bin_size)
+    assert bin_size is None, "Zoom levels need a binary track file."
+    track = pd.read_table(path, sep='\t', header=0)
+    return track[ (track['chr'] == chrom) & (track['end'] > start) & (track['start'] < end) ].reset_index(drop=True)
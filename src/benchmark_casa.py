@@ -0,0 +1,377 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+CASA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'casa')
+sys.path.insert(0, CASA_DIR)
+from genome_utils import merge_bed, get_replicating_peaks, filter_by_guide_coverage, get_sliding_windows, IntervalIndex
+from sim_hcrflowfish import mvn_mle, simulate_hff, simulate_sort
+from proc_utils import reset_peak_rss, peak_rss
+
+ENCODE_HEADER = ['chrom','chromStart','chromEnd','name','SeqCounts','strandPerturbationTarget',
+                 'PerturbationTargetID','chrTSS','startTSS','endTSS','strandGene','measuredGeneSymbol',
+                 'measuredEnsemblID','guideSpacerSeq','guideSeq','guideType','Notes']
+
+STAGES = ['encode2casa','track_builder','call_peaks','genome_utils']
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Time the CASA pipeline on synthetic screens of several sizes built from simulated HCR Flow-FISH counts.')
+    parser.add_argument('--example_cells', required=True,
+                        help='Flow-cytometry readings for cells expressing the HCR target.')
+    parser.add_argument('--control_cells', required=True,
+                        help='Flow-cytometry readings for cells with zero expression of the HCR target.')
+    parser.add_argument('--output','-o',required=True,help='JSON file for benchmark results. Can serve as a later --baseline.')
+    parser.add_argument('--baseline','-b',type=str,default=None,help='Earlier --output to compare against.')
+    parser.add_argument('--tolerance','-t',type=float,default=1.25,help='Time or memory ratio to baseline flagged as a regression (or its inverse as a win).')
+    parser.add_argument('--min_seconds',type=float,default=1.,help='Stages this quick in both runs are not judged on time, as their timings are mostly noise.')
+    parser.add_argument('--fail_on_regression',action='store_true',help='Exit non-zero if any regression is flagged.')
+    parser.add_argument('--scales','-s',type=str,default='1000x1,10000x4,100000x12,1000000x24',
+                        help='Comma separated screen sizes as GUIDESxCHROMOSOMES.')
+    parser.add_argument('--stages',type=str,default=','.join(STAGES),help='Comma separated stages to run, from: {}.'.format(', '.join(STAGES)))
+    parser.add_argument('--work_dir','-w',type=str,default=None,help='Directory for synthetic screens and stage outputs. Defaults to a temporary directory.')
+    parser.add_argument('--timeout',type=int,default=3600,help='Seconds before a pipeline script is killed and marked timed out.')
+    parser.add_argument('--sample_windows',type=int,default=20,help='Windows sampled by call_peaks at each scale. Preprocessing always covers the whole screen.')
+    parser.add_argument('--call_peaks_args',type=str,default='',help='Extra call_peaks.py arguments, e.g. "--likelihood collapsed --workers 8".')
+    parser.add_argument('--window_size',type=int,default=100,help='call_peaks window size.')
+    parser.add_argument('--step_size',type=int,default=100,help='call_peaks step size.')
+    parser.add_argument('--target_channel', type=str, default='APC-A',
+                        help='Cytometry channel corresponding to target gene, must be reflected as a header in input files')
+    parser.add_argument('--housekeeping_channel', type=str, default='FSC-A',
+                        help='Cytometry channel corresponding to housekeeping gene, must be reflected as a header in input files')
+    parser.add_argument('--pool_guides',type=int,default=1000,help='Simulated control guides whose counts are resampled for null guides. A tenth as many knockdown guides are simulated for CRE guides.')
+    parser.add_argument('--sorting_depth',type=int,default=200,help='Mean number of simulated cells per guide.')
+    parser.add_argument('--knockdown_fraction',type=float,default=0.5,help='Causal guide knockdown effect as a fraction of total possible effect.')
+    parser.add_argument('--guide_noise_fraction',type=float,default=0.1,help='Fraction of noise attributable to guide effects.')
+    parser.add_argument('--control_fraction',type=float,default=0.02,help='Fraction of guides that are non-targeting controls (at least 200).')
+    parser.add_argument('--guide_spacing',type=int,default=25,help='Distance between neighbouring targeting guides.')
+    parser.add_argument('--cre_every',type=int,default=500,help='A CRE starts every this many targeting guides.')
+    parser.add_argument('--cre_guides',type=int,default=30,help='Targeting guides inside each CRE.')
+    parser.add_argument('--random_seed','-r',type=int,default=0,help='Seed for simulation and resampling.')
+    args = parser.parse_args()
+    return args
+
+def check_args(args):
+    assert args.tolerance > 1, "Tolerance must be a ratio above 1."
+    assert args.sample_windows > 0, "Need at least one sampled window."
+    assert args.cre_guides < args.cre_every, "CREs can't cover every guide."
+    for stage in args.stages.split(','):
+        assert stage in STAGES, "Unknown stage {}.".format(stage)
+    for scale in args.scales.split(','):
+        n_guides, n_chrom = [ int(x) for x in scale.split('x') ]
+        assert n_chrom >= 1 and n_guides > n_chrom, "Scale {} needs more guides than chromosomes.".format(scale)
+    return True
+
+def parse_scale(scale):
+    n_guides, n_chrom = [ int(x) for x in scale.split('x') ]
+    return n_guides, n_chrom
+
+def run_script(cmd, timeout):
+    """
+    Run a pipeline script, returning its wall time, peak RSS in MB 
+    and a status of ok, failed or timeout. Peak RSS is the script's 
+    VmHWM, polled from /proc every 50ms while it runs, so the last 
+    poll interval and any processes it spawns are missed; NaN if it 
+    could not be read.
+    """
+    print(' '.join(cmd), file=sys.stderr)
+    start = time.time()
+    proc  = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    status= 'ok'
+    peak  = None
+    while proc.poll() is None:
+        rss  = peak_rss(proc.pid)
+        if rss is not None:
+            peak = rss if peak is None else max(peak, rss)
+        if time.time() - start > timeout:
+            proc.kill()
+            proc.wait()
+            status = 'timeout'
+            break
+        time.sleep(0.05)
+    if status == 'ok' and proc.returncode != 0:
+        status = 'failed'
+    return time.time() - start, (np.nan if peak is None else peak), status
+
+def simulate_pools(args):
+    """
+    Per-guide (LS_reads, HS_reads) pools from sim_hcrflowfish: null
+    counts from simulated control guides and CRE counts from guides
+    with the requested knockdown.
+    """
+    targ_data = pd.read_csv(args.example_cells, header=0)
+    ctrl_data = pd.read_csv(args.control_cells, header=0)
+    targ_data = targ_data[ ~((targ_data[args.target_channel] == 0) | (targ_data[args.housekeeping_channel] == 0)) ]
+    ctrl_data = ctrl_data[ ~((ctrl_data[args.target_channel] == 0) | (ctrl_data[args.housekeeping_channel] == 0)) ]
+    targ_mean, targ_cov = mvn_mle( np.log(targ_data.loc[:,(args.housekeeping_channel, args.target_channel)]).values.T )
+    ctrl_mean, ctrl_cov = mvn_mle( np.log(ctrl_data.loc[:,(args.housekeeping_channel, args.target_channel)]).values.T )
+    sim_cells = simulate_hff(targ_mean, targ_cov, ctrl_mean, ctrl_cov,
+                             args.target_channel, args.housekeeping_channel,
+                             n_control_guides=args.pool_guides,
+                             n_targeting_guides=max(1, args.pool_guides // 10),
+                             sort_depth=args.sorting_depth,
+                             ko_fractions=[args.knockdown_fraction],
+                             guide_noise_fraction=args.guide_noise_fraction)
+    sim_sort  = simulate_sort(sim_cells)
+    is_null   = sim_sort.index.str.startswith('NT_')
+    null_pool = sim_sort.loc[ is_null, ('LS_reads','HS_reads') ].values
+    hit_pool  = sim_sort.loc[~is_null, ('LS_reads','HS_reads') ].values
+    return null_pool, hit_pool
+
+def synth_screen(null_pool, hit_pool, n_guides, n_chrom, args):
+    """
+    A tiled screen of n_guides guides over n_chrom chromosomes, with
+    counts resampled from the simulated pools. The first cre_guides of
+    every cre_every targeting guides on a chromosome form a CRE.
+
+    Returns
+    ----------
+    screen: DataFrame
+        Coordinates, LS_reads, HS_reads, strand and is_cre per guide.
+    truth: DataFrame
+        chr, start, end of the target area covered by each CRE.
+    """
+    n_ctrl = max(200, int(args.control_fraction * n_guides))
+    n_targ = n_guides - n_ctrl
+    screens= [ pd.DataFrame({'Coordinates': [ 'NT_{}'.format(i) for i in range(n_ctrl) ],
+                             'strand': '.', 'is_cre': False}) ]
+    truth  = []
+    for c, chrom_guides in enumerate(np.array_split(np.arange(n_targ), n_chrom)):
+        chrom  = 'chr{}'.format(c+1)
+        k      = np.arange(chrom_guides.shape[0])
+        start  = 10000 + k * args.guide_spacing
+        end    = start + 20
+        strand = np.where(np.random.uniform(size=k.shape[0]) < 0.5, '+', '-')
+        is_cre = (k % args.cre_every) < args.cre_guides
+        screens.append( pd.DataFrame({'Coordinates': [ '{}:{}-{}:{}'.format(chrom, s, e, d)
+                                                       for s, e, d in zip(start, end, strand) ],
+                                      'strand': strand, 'is_cre': is_cre}) )
+        area_lo = np.where(strand == '+', end - 152, end - 146)
+        area_hi = np.where(strand == '+', end + 147, end + 153)
+        block   = k // args.cre_every
+        for b in np.unique(block[is_cre]):
+            in_block = is_cre & (block == b)
+            truth.append( [chrom, area_lo[in_block].min(), area_hi[in_block].max()] )
+    screen = pd.concat(screens, axis=0, ignore_index=True)
+    counts = np.where( screen['is_cre'].values[:,None],
+                       hit_pool[ np.random.randint(hit_pool.shape[0], size=screen.shape[0]) ],
+                       null_pool[ np.random.randint(null_pool.shape[0], size=screen.shape[0]) ] )
+    screen['LS_reads'] = counts[:,0]
+    screen['HS_reads'] = counts[:,1]
+    return screen, pd.DataFrame(truth, columns=['chr','start','end'])
+
+def write_encode_bins(screen, pos_path, neg_path):
+    """
+    The screen as ENCODE standard positive (LS) and negative (HS) bin
+    tables, laid out so encode2casa.py recovers its coordinates.
+    """
+    is_ctrl = (screen['strand'] == '.').values
+    is_minus= (screen['strand'] == '-').values
+    coords  = screen['Coordinates'].str.extract(r'(?P<chrom>[^:]+):(?P<start>\d+)-(?P<end>\d+)')
+    start   = coords['start'].fillna(0).astype(np.int64).values
+    end     = coords['end'].fillna(0).astype(np.int64).values
+    table   = pd.DataFrame('.', index=screen.index, columns=ENCODE_HEADER)
+    table['chrom'] = np.where(is_ctrl, 'NT', coords['chrom'])
+    ## encode2casa puts + guides at [chromStart-20, chromStart] and - guides at [chromEnd+1, chromEnd+21]
+    table['chromEnd']   = np.where(is_minus, start - 1, end + 20)
+    table['chromStart'] = np.where(is_minus, start - 21, end)
+    table['strandPerturbationTarget'] = screen['strand']
+    table['PerturbationTargetID'] = screen['Coordinates']
+    table['guideType'] = np.where(is_ctrl, 'negative_control', 'targeting')
+    for path, column in [(pos_path, 'LS_reads'), (neg_path, 'HS_reads')]:
+        table['SeqCounts'] = screen[column].values
+        table.to_csv(path, sep='\t', header=False, index=False, quoting=csv.QUOTE_NONE)
+    return None
+
+def synth_peak_calls(truth, n_assays=2, n_reps=3, n_false=None):
+    """
+    Replicate peak calls around the CREs: each replicate recovers most
+    CREs with jittered bounds and adds some false peaks.
+    """
+    n_false = truth.shape[0] if n_false is None else n_false
+    calls   = []
+    for a in range(n_assays):
+        for r in range(n_reps):
+            keep = truth[ np.random.uniform(size=truth.shape[0]) < 0.9 ].copy()
+            keep['start'] = keep['start'] + np.random.randint(-50, 50, size=keep.shape[0])
+            keep['end']   = keep['end'] + np.random.randint(-50, 50, size=keep.shape[0])
+            false = truth.sample(n=n_false, replace=True, random_state=np.random.randint(2**31 - 1)).copy()
+            false['start'] = false['start'] + 5000 + np.random.randint(0, 5000, size=n_false)
+            false['end']   = false['start'] + 200
+            reps  = pd.concat([keep, false], axis=0, ignore_index=True)
+            reps['assay'] = 'assay_{}'.format(a)
+            reps['replicate'] = 'rep_{}'.format(r)
+            calls.append( reps )
+    return pd.concat(calls, axis=0, ignore_index=True)
+
+def record(results, scale, n_guides, stage, seconds, peak_mb, status='ok', units=None, n_units=None, **extra):
+    n_units = n_guides if n_units is None else n_units
+    entry = OrderedDict([ ('scale', scale), ('stage', stage), ('status', status),
+                          ('seconds', seconds), ('peak_mb', peak_mb),
+                          ('throughput', n_units / seconds if (status == 'ok' and seconds > 0) else None),
+                          ('throughput_unit', '{}/s'.format(units if units is not None else 'guides')) ])
+    entry.update( extra )
+    results.append( entry )
+    print("{}\t{}\t{}\t{:.2f}s\t{:.0f} MB".format(scale, stage, status, seconds, peak_mb), file=sys.stderr)
+    return entry
+
+def bench_call_peaks(results, scale, n_guides, screen_path, screen, truth, work_dir, args):
+    """
+    Run call_peaks.py on one chunk of about --sample_windows windows,
+    then read its telemetry for stage and per-window costs and score
+    the chunk's calls against the CREs.
+    """
+    targeting = screen[ screen['strand'] != '.' ]
+    ends      = targeting['Coordinates'].str.extract(r'^(?P<chrom>chr\d+):\d+-(?P<end>\d+)')
+    chrom_idx = pd.factorize(ends['chrom'], sort=True)[0]
+    end       = ends['end'].astype(np.int64).values
+    pos_array = np.stack([ chrom_idx,
+                           np.where(targeting['strand'] == '+', end - 152, end - 146),
+                           np.where(targeting['strand'] == '+', end + 147, end + 153) ], axis=1)
+    n_windows = get_sliding_windows(pos_array, args.window_size, args.step_size).shape[0]
+    job_range = max(1, n_windows // args.sample_windows)
+    out_path  = os.path.join(work_dir, 'call_peaks.bed')
+    telemetry = os.path.join(work_dir, 'call_peaks.telemetry.jsonl')
+    journal   = os.path.join(work_dir, 'call_peaks.journal')
+    ## Telemetry is appended to, so records left in a reused --work_dir would mix with this run's
+    for path in [telemetry, journal]:
+        if os.path.exists(path):
+            os.remove(path)
+    cmd = [sys.executable, os.path.join(CASA_DIR, 'call_peaks.py'), screen_path, out_path,
+           '-ji', '0', '-jr', str(job_range), '-ws', str(args.window_size), '-ss', str(args.step_size),
+           '--telemetry', telemetry, '--journal', journal,
+           '--random_seed', str(args.random_seed)] + args.call_peaks_args.split()
+    seconds, peak_mb, status = run_script(cmd, args.timeout)
+    record(results, scale, n_guides, 'call_peaks', seconds, peak_mb, status)
+    if status != 'ok':
+        return None
+    with open(telemetry, 'r') as f:
+        entries = [ json.loads(line) for line in f ]
+    for entry in entries:
+        if entry['type'] == 'stage':
+            units   = 'windows' if entry['stage'] == 'sampling' else None
+            n_units = entry.get('windows', None)
+            record(results, scale, n_guides, 'call_peaks.'+entry['stage'], entry['seconds'], float('nan'),
+                   units=units, n_units=n_units)
+    windows = pd.DataFrame([ entry for entry in entries if entry['type'] == 'window' ])
+    if windows.shape[0] == 0:
+        return None
+    ## Calls against CRE truth: a window holding any CRE should pass
+    calls = pd.read_table(out_path, header=None, usecols=[0,1,2,4], names=['chr','start','end','pass'])
+    is_cre = IntervalIndex(truth.values.astype(object)).count(calls.values[:,:3]) > 0
+    passed = calls['pass'].astype(str).values == 'True'
+    tp, fp, fn = [ int(x) for x in [(passed & is_cre).sum(), (passed & ~is_cre).sum(), (~passed & is_cre).sum()] ]
+    record(results, scale, n_guides, 'call_peaks.window', windows['sampling_seconds'].sum(),
+           windows['peak_rss_mb'].max(), units='windows', n_units=windows.shape[0],
+           mean_guides=windows['guides'].mean(), mean_draws=windows['draws'].mean(),
+           max_rhat=windows['rhat'].astype(float).max(), min_ess_per_sec=windows['ess_per_sec'].astype(float).min(),
+           divergences=int(windows['divergences'].astype(float).fillna(0).sum()),
+           precision=tp / float(tp + fp) if tp + fp > 0 else None,
+           recall=tp / float(tp + fn) if tp + fn > 0 else None)
+    return None
+
+def bench_genome_utils(results, scale, n_guides, screen, truth):
+    peak_calls = synth_peak_calls(truth)
+    guide_coords = list(screen['Coordinates'])
+    for stage, fn in [ ('genome_utils.merge_bed', lambda: merge_bed(peak_calls.loc[:,('chr','start','end')])),
+                       ('genome_utils.get_replicating_peaks', lambda: get_replicating_peaks(peak_calls)),
+                       ('genome_utils.filter_by_guide_coverage',
+                        lambda: filter_by_guide_coverage(merge_bed(peak_calls.loc[:,('chr','start','end')]), guide_coords)) ]:
+        reset_peak_rss()
+        start  = time.time()
+        fn()
+        record(results, scale, n_guides, stage, time.time() - start, peak_rss(),
+               units='peaks', n_units=peak_calls.shape[0])
+    return None
+
+def compare_to_baseline(results, baseline, tolerance, min_seconds=1.):
+    """
+    Join results to a baseline on (scale, stage) and flag time or memory
+    changes past the tolerance ratio. Returns the comparison table.
+    """
+    base = pd.DataFrame(baseline['results']).set_index(['scale','stage'])
+    assert not base.index.duplicated().any(), \
+           "Baseline has repeated (scale, stage) results: {}".format(list(base.index[ base.index.duplicated() ].unique()))
+    rows = []
+    for entry in results:
+        key = (entry['scale'], entry['stage'])
+        if key not in base.index:
+            continue
+        ref = base.loc[key]
+        time_ratio = entry['seconds'] / ref['seconds'] if ref['seconds'] > 0 else np.nan
+        if max(entry['seconds'], ref['seconds']) < min_seconds:
+            time_ratio = np.nan
+        mem_ratio  = entry['peak_mb'] / ref['peak_mb'] if ref['peak_mb'] > 0 else np.nan
+        if entry['status'] != 'ok' and ref['status'] == 'ok':
+            verdict = 'REGRESSION ({})'.format(entry['status'])
+        elif time_ratio > tolerance or mem_ratio > tolerance:
+            verdict = 'REGRESSION'
+        elif time_ratio < 1. / tolerance or mem_ratio < 1. / tolerance:
+            verdict = 'improved'
+        else:
+            verdict = ''
+        rows.append( [entry['scale'], entry['stage'], ref['seconds'], entry['seconds'], time_ratio,
+                      ref['peak_mb'], entry['peak_mb'], mem_ratio, verdict] )
+    return pd.DataFrame(rows, columns=['scale','stage','base_s','now_s','time_ratio',
+                                       'base_mb','now_mb','mem_ratio','verdict'])
+
+def main(args):
+    np.random.seed(args.random_seed)
+    stages   = args.stages.split(',')
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='casa_bench_')
+    print("Simulate count pools", file=sys.stderr)
+    null_pool, hit_pool = simulate_pools(args)
+    results = []
+    for scale in args.scales.split(','):
+        n_guides, n_chrom = parse_scale(scale)
+        scale_dir = os.path.join(work_dir, scale)
+        os.makedirs(scale_dir, exist_ok=True)
+        print("Build {} guide screen over {} chromosomes".format(n_guides, n_chrom), file=sys.stderr)
+        screen, truth = synth_screen(null_pool, hit_pool, n_guides, n_chrom, args)
+        screen_path = os.path.join(scale_dir, 'screen.txt')
+        screen.loc[:,('Coordinates','LS_reads','HS_reads')].to_csv(screen_path, sep='\t', index=False, quoting=csv.QUOTE_NONE)
+        if 'encode2casa' in stages:
+            pos_path, neg_path = os.path.join(scale_dir, 'positive.tsv'), os.path.join(scale_dir, 'negative.tsv')
+            write_encode_bins(screen, pos_path, neg_path)
+            cmd = [sys.executable, os.path.join(CASA_DIR, 'encode2casa.py'), '--positive_bin', pos_path,
+                   '--negative_bin', neg_path, '--output', os.path.join(scale_dir, 'encode2casa.txt')]
+            record(results, scale, n_guides, 'encode2casa', *run_script(cmd, args.timeout))
+        if 'track_builder' in stages:
+            cmd = [sys.executable, os.path.join(CASA_DIR, 'track_builder.py'), screen_path,
+                   os.path.join(scale_dir, 'track.bedgraph')]
+            record(results, scale, n_guides, 'track_builder', *run_script(cmd, args.timeout))
+        if 'call_peaks' in stages:
+            bench_call_peaks(results, scale, n_guides, screen_path, screen, truth, scale_dir, args)
+        if 'genome_utils' in stages:
+            bench_genome_utils(results, scale, n_guides, screen, truth)
+
+    config = OrderedDict([ (key, value) for key, value in vars(args).items()
+                           if key not in ['output','baseline','tolerance','min_seconds','fail_on_regression','work_dir'] ])
+    with open(args.output, 'w') as f:
+        json.dump(OrderedDict([ ('config', config), ('results', results) ]), f, indent=1)
+
+    regressions = 0
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['config'] != json.loads(json.dumps(config)):
+            print("Warning! Baseline was run with different settings.", file=sys.stderr)
+        report = compare_to_baseline(results, baseline, args.tolerance, args.min_seconds)
+        print(report.to_string(index=False))
+        regressions = report['verdict'].str.startswith('REGRESSION').sum()
+        print("{} regressions past {}x".format(regressions, args.tolerance), file=sys.stderr)
+    print("Done.", file=sys.stderr)
+    if args.fail_on_regression and regressions > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    args = get_args()
+    check_args(args)
+    main(args)
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+import csv
+import argparse
+import tempfile
+import subprocess
+
+CASA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'casa')
+sys.path.insert(0, CASA_DIR)
+from sim_hcrflowfish import mvn_mle, simulate_hff, simulate_sort
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Check that call_peaks.py gives matching HDRs and calls with the full '+\
+                                                 'and collapsed likelihoods on a screen simulated from HCR Flow-FISH cells.')
+    parser.add_argument('--example_cells', required=True,
+                        help='Flow-cytometry readings for cells expressing the HCR target.')
+    parser.add_argument('--control_cells', required=True,
+                        help='Flow-cytometry readings for cells with zero expression of the HCR target.')
+    parser.add_argument('--target_channel', type=str, default='APC-A',
+                        help='Cytometry channel corresponding to target gene, must be reflected as a header in input files')
+    parser.add_argument('--housekeeping_channel', type=str, default='FSC-A',
+                        help='Cytometry channel corresponding to housekeeping gene, must be reflected as a header in input files')
+    parser.add_argument('--n_control_guides', type=int, default=1000,
+                        help='Number of simulated non-targeting control guides.')
+    parser.add_argument('--n_targeting_guides', type=int, default=30,
+                        help='Number of simulated guides per targeted region.')
+    parser.add_argument('--n_regions', type=int, default=4,
+                        help='Simulated targeted regions, alternating between no knockdown and --knockdown_fraction.')
+    parser.add_argument('--sorting_depth', type=int, default=200,
+                        help='Mean number of simulated cells per guide.')
+    parser.add_argument('--knockdown_fraction', type=float, default=0.5,
+                        help='Causal guide knockdown effect as a fraction of total possible effect.')
+    parser.add_argument('--guide_noise_fraction', type=float, default=0.1,
+                        help='Fraction of noise attributable to guide effects.')
+    parser.add_argument('--window_size','-ws',type=int,default=200,help='call_peaks window size.')
+    parser.add_argument('--step_size','-ss',type=int,default=200,help='call_peaks step size.')
+    parser.add_argument('--tolerance','-t',type=float,default=0.15,
+                        help='Largest difference allowed between HDR bounds of the two likelihoods.')
+    parser.add_argument('--call_peaks_args',type=str,default='',help='Extra call_peaks.py arguments for both runs, e.g. "--chains 4".')
+    parser.add_argument('--work_dir','-w',type=str,default=None,help='Directory for the screen and peak calls. Defaults to a temporary directory.')
+    parser.add_argument('--random_seed','-r',type=int,default=0,help='Seed for simulation, downsampling and sampling.')
+    args = parser.parse_args()
+    return args
+
+def check_args(args):
+    assert args.n_regions > 0, "Need at least one targeted region."
+    assert args.tolerance > 0, "Tolerance must be positive."
+    return True
+
+def simulate_screen(args):
+    """
+    Guide counts for a screen of n_regions targeted regions, every
+    other one with a knockdown effect, plus non-targeting controls.
+    """
+    targ_data = pd.read_csv(args.example_cells, header=0)
+    ctrl_data = pd.read_csv(args.control_cells, header=0)
+    targ_data = targ_data[ ~((targ_data[args.target_channel] == 0) | (targ_data[args.housekeeping_channel] == 0)) ]
+    ctrl_data = ctrl_data[ ~((ctrl_data[args.target_channel] == 0) | (ctrl_data[args.housekeeping_channel] == 0)) ]
+    targ_mean, targ_cov = mvn_mle( np.log(targ_data.loc[:,(args.housekeeping_channel, args.target_channel)]).values.T )
+    ctrl_mean, ctrl_cov = mvn_mle( np.log(ctrl_data.loc[:,(args.housekeeping_channel, args.target_channel)]).values.T )
+    sim_cells = simulate_hff(targ_mean, targ_cov, ctrl_mean, ctrl_cov,
+                             args.target_channel, args.housekeeping_channel,
+                             n_control_guides=args.n_control_guides,
+                             n_targeting_guides=args.n_targeting_guides,
+                             sort_depth=args.sorting_depth,
+                             ko_fractions=[ args.knockdown_fraction * (k % 2) for k in range(args.n_regions) ],
+                             guide_noise_fraction=args.guide_noise_fraction)
+    return simulate_sort(sim_cells)
+
+def call_peaks(screen_path, out_path, likelihood, args):
+    cmd = [sys.executable, os.path.join(CASA_DIR, 'call_peaks.py'), screen_path, out_path,
+           '-ws', str(args.window_size), '-ss', str(args.step_size), '--likelihood', likelihood,
+           '--random_seed', str(args.random_seed)] + args.call_peaks_args.split()
+    print(' '.join(cmd), file=sys.stderr)
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+    calls = pd.read_table(out_path, header=None, names=['chr','start','end','hdr','pass','strand'])
+    hdr   = calls['hdr'].str.split(',', expand=True).astype(float)
+    calls['lo'] = hdr[0]
+    calls['hi'] = hdr[1]
+    return calls
+
+def main(args):
+    np.random.seed(args.random_seed)
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='casa_parity_')
+    print("Simulate screen", file=sys.stderr)
+    screen_path = os.path.join(work_dir, 'screen.txt')
+    simulate_screen(args).to_csv(screen_path, sep='\t', index_label='Coordinates', quoting=csv.QUOTE_NONE)
+    full      = call_peaks(screen_path, os.path.join(work_dir, 'full.bed'), 'full', args)
+    collapsed = call_peaks(screen_path, os.path.join(work_dir, 'collapsed.bed'), 'collapsed', args)
+    assert full.loc[:,('chr','start','end')].equals(collapsed.loc[:,('chr','start','end')]), \
+           "Likelihoods were fit over different windows."
+    report = full.loc[:,('chr','start','end','lo','hi','pass')].copy()
+    report['collapsed_lo']   = collapsed['lo']
+    report['collapsed_hi']   = collapsed['hi']
+    report['collapsed_pass'] = collapsed['pass']
+    report['d_lo'] = (report['lo'] - report['collapsed_lo']).abs()
+    report['d_hi'] = (report['hi'] - report['collapsed_hi']).abs()
+    print(report.to_string(index=False))
+    n_calls = report['pass'].sum()
+    print("{} windows, {} calls; max |d_lo| {:.4f}, max |d_hi| {:.4f}".format(
+              report.shape[0], n_calls, report['d_lo'].max(), report['d_hi'].max()), file=sys.stderr)
+    assert (report['pass'] == report['collapsed_pass']).all(), "Peak calls differ between likelihoods."
+    assert (report['d_lo'] <= args.tolerance).all() and (report['d_hi'] <= args.tolerance).all(), \
+           "HDR bounds differ by more than {} between likelihoods.".format(args.tolerance)
+    print("Likelihoods agree.", file=sys.stderr)
+    return report
+
+if __name__ == "__main__":
+    args = get_args()
+    check_args(args)
+    main(args)
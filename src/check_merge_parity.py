@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'casa'))
+from genome_utils import merge_intervals, merge_bed, get_replicating_peaks
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Check merge_intervals, merge_bed and get_replicating_peaks against '+\
+                                                 'the original per-interval loops on random interval sets.')
+    parser.add_argument('--trials','-n',type=int,default=500,help='Random interval sets to check.')
+    parser.add_argument('--max_intervals',type=int,default=60,help='Largest interval set drawn.')
+    parser.add_argument('--random_seed','-r',type=int,default=0,help='Seed for interval sets.')
+    args = parser.parse_args()
+    return args
+
+def check_args(args):
+    assert args.trials > 0, "Need at least one trial."
+    assert args.max_intervals > 0, "Need at least one interval."
+    return True
+
+#######################################
+##
+## Original loop implementations
+##
+#######################################
+
+def loop_merge_intervals(intervals, count=False, req_overlap=False):
+    sorted_intervals = intervals[ intervals[:,0].argsort() ]
+    merged_intervals = sorted_intervals[0:1]
+    counts = [1]
+    offset = int(req_overlap)
+    for i in range(1,sorted_intervals.shape[0]):
+        next_interval = sorted_intervals[i:i+1]
+        last_interval = merged_intervals[-1:]
+        if next_interval[0,0] <= (last_interval[0,1]-offset):
+            new_max = max( next_interval[0,1], last_interval[0,1] )
+            merged_intervals[-1,1] = new_max
+            counts[-1] += 1
+        else:
+            merged_intervals = np.concatenate([merged_intervals,next_interval],
+                                              axis=0)
+            counts.append(1)
+    if count:
+        return merged_intervals, counts
+    else:
+        return merged_intervals
+
+def loop_merge_bed(bed_df, count=False, req_overlap=False):
+    bed_ = bed_df.sort_values(['chr','start'],axis=0) \
+                 .reset_index(drop=True)
+    chr_set = bed_['chr'].unique()
+    hold_   = []
+    for chrom in chr_set:
+        sub_bed = bed_.loc[ bed_['chr'] == chrom, ('start','end') ]
+        if count:
+            merged_pos, counts = loop_merge_intervals(sub_bed.values, True, req_overlap)
+            reorg_df= pd.DataFrame({'chr': chrom,
+                                    'start': merged_pos[:,0],
+                                    'end': merged_pos[:,1],
+                                    'count': counts})
+        else:
+            merged_pos = loop_merge_intervals(sub_bed.values, False, req_overlap)
+            reorg_df= pd.DataFrame({'chr': chrom,
+                                    'start': merged_pos[:,0],
+                                    'end': merged_pos[:,1]})
+        hold_.append(reorg_df)
+    return pd.concat(hold_, axis=0).reset_index(drop=True)
+
+def loop_get_replicating_peaks(bed_df, use_singletons=False):
+    uniq_assays = list(bed_df['assay'].unique())
+    assay_reps  = [ bed_df.loc[bed_df['assay'] == assay,'replicate'] \
+                      .unique()
+                    for assay in uniq_assays ]
+    assay_count = [ len(rep_list) for rep_list in assay_reps ]
+    result_peaks= []
+    for assay, reps, count in zip(uniq_assays, assay_reps, assay_count):
+        if count == 1:
+            if use_singletons:
+                result_peaks.append( bed_df.loc[ bed_df['assay'] == assay, ('chr','start','end') ] )
+            else:
+                pass
+        else:
+            in_assay = []
+            assay_sub= bed_df[ bed_df['assay'] == assay ]
+            for rep in reps:
+                in_rep   = assay_sub[ assay_sub['replicate'] == rep ]
+                rep_merge= loop_merge_bed(in_rep)
+                in_assay.append( rep_merge )
+            assay_merge = pd.concat(in_assay, axis=0).reset_index(drop=True)
+            assay_merge = loop_merge_bed( assay_merge, count=True, req_overlap=True )
+            result_peaks.append( assay_merge.loc[ assay_merge['count'] > 1, ('chr','start','end') ] )
+    return loop_merge_bed(pd.concat( result_peaks, axis=0 ).reset_index(drop=True))
+
+#######################################
+##
+## Random interval sets
+##
+#######################################
+
+def random_intervals(n):
+    """
+    n intervals with end > start packed into a short span, so many
+    overlap, touch (start equal to another's end) or nest.
+    """
+    starts = np.random.randint(0, 4*n + 10, size=n)
+    ends   = starts + np.random.randint(1, 30, size=n)
+    ## Touching: start exactly at an earlier interval's end
+    touch  = np.random.uniform(size=n) < 0.2
+    ends[touch]   = ends[touch] - starts[touch]
+    starts[touch] = ends[np.random.randint(n, size=touch.sum())]
+    ends[touch]   = ends[touch] + starts[touch]
+    ## Nested: strictly inside another interval
+    parent = np.random.randint(n, size=n)
+    nest   = (np.random.uniform(size=n) < 0.2) & (ends[parent] - starts[parent] > 2)
+    starts[nest] = starts[parent[nest]] + 1
+    ends[nest]   = ends[parent[nest]] - 1
+    return np.stack([starts, ends], axis=1)
+
+def random_bed(n):
+    bed = pd.DataFrame(random_intervals(n), columns=['start','end'])
+    bed.insert(0, 'chr', np.random.choice(['chr1','chr2','chr10','chrX'], size=n))
+    bed['assay']     = np.random.choice(['assay_0','assay_1','assay_2'], size=n)
+    bed['replicate'] = np.random.choice(['rep_0','rep_1','rep_2'], size=n)
+    return bed
+
+def same_frame(a, b):
+    return a.shape == b.shape and (a.columns == b.columns).all() and \
+           all([ (a[col].values == b[col].values).all() for col in a.columns ])
+
+def main(args):
+    np.random.seed(args.random_seed)
+    n_checks = 0
+    for trial in range(args.trials):
+        n = np.random.randint(1, args.max_intervals + 1)
+        intervals = random_intervals(n)
+        for count in [False, True]:
+            for req_overlap in [False, True]:
+                expect = loop_merge_intervals(intervals.copy(), count, req_overlap)
+                result = merge_intervals(intervals.copy(), count, req_overlap)
+                if count:
+                    assert (expect[0] == result[0]).all() and expect[1] == list(result[1]), \
+                           "merge_intervals(count=True, req_overlap={}) differs on {}".format(req_overlap, intervals.tolist())
+                else:
+                    assert expect.shape == result.shape and (expect == result).all(), \
+                           "merge_intervals(req_overlap={}) differs on {}".format(req_overlap, intervals.tolist())
+                n_checks += 1
+        bed = random_bed(n)
+        for count in [False, True]:
+            for req_overlap in [False, True]:
+                expect = loop_merge_bed(bed, count, req_overlap)
+                result = merge_bed(bed, count, req_overlap)
+                assert same_frame(expect, result), \
+                       "merge_bed(count={}, req_overlap={}) differs on\n{}".format(count, req_overlap, bed.to_string())
+                n_checks += 1
+        for use_singletons in [False, True]:
+            try:
+                expect = loop_get_replicating_peaks(bed, use_singletons)
+            except ValueError:
+                ## The loop can't concatenate when no assay contributes peaks
+                continue
+            result = get_replicating_peaks(bed, use_singletons)
+            assert same_frame(expect, result), \
+                   "get_replicating_peaks(use_singletons={}) differs on\n{}".format(use_singletons, bed.to_string())
+            n_checks += 1
+    print("{} checks over {} random interval sets passed.".format(n_checks, args.trials), file=sys.stderr)
+    return n_checks
+
+if __name__ == "__main__":
+    args = get_args()
+    check_args(args)
+    main(args)
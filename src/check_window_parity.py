@@ -0,0 +1,95 @@
+import numpy as np
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'casa'))
+from genome_utils import get_sliding_windows, get_window_overlaps
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Check get_sliding_windows and get_window_overlaps against the '+\
+                                                 'original per-window check_overlap_bed scans on random guide sets.')
+    parser.add_argument('--trials','-n',type=int,default=200,help='Random guide sets to check, each with and without offsets.')
+    parser.add_argument('--max_guides',type=int,default=80,help='Largest guide set drawn.')
+    parser.add_argument('--random_seed','-r',type=int,default=0,help='Seed for guide sets.')
+    args = parser.parse_args()
+    return args
+
+def check_args(args):
+    assert args.trials > 0, "Need at least one trial."
+    assert args.max_guides > 0, "Need at least one guide."
+    return True
+
+#######################################
+##
+## Original scan implementation
+##
+#######################################
+
+def check_overlap_bed(interval, array):
+    height = array.shape[0]
+    intervals= np.stack([np.tile(interval,(height,1)), array],axis=0)
+    intervals[:,:,1:3] = intervals[:,:,1:3].astype(int)
+    swaghook = (intervals[0,:,1] < intervals[1,:,1]).astype(int)
+    chrom    = (intervals[0,:,0] == intervals[1,:,0])
+    overlap  = intervals[1-swaghook,np.arange(height),2] > intervals[swaghook,np.arange(height),1]
+    return overlap & chrom
+
+def scan_windows(pos_array, window_size, step_size):
+    sliding_window = []
+    for idx in np.unique(pos_array[:,0]):
+        lims = (pos_array[pos_array[:,0] == idx, 1].min(), pos_array[pos_array[:,0] == idx, 2].max())
+        a_window = np.vstack( (np.arange(*lims,step_size),
+                               np.minimum(np.arange(*lims,step_size)+window_size,lims[1])) ).T
+        sliding_window.append( np.concatenate( (np.tile( [[idx]], (a_window.shape[0],1) ), a_window), axis=1 ) )
+    sliding_window = np.concatenate(sliding_window)
+    return sliding_window[[ np.any(check_overlap_bed(interval,pos_array))
+                            for interval in sliding_window ]]
+
+def scan_overlaps(pos_array, sliding_window):
+    ovl_array = np.stack([ check_overlap_bed(guide_interval,sliding_window)
+                           for guide_interval in pos_array ],axis=0)
+    row_pairs, win_pairs = np.nonzero(ovl_array)
+    order = np.lexsort((row_pairs, win_pairs))
+    return win_pairs[order], row_pairs[order]
+
+def random_guides(n, no_offsets):
+    """
+    Guide target areas on up to three chromosomes, as call_peaks builds
+    them: 300bp around the cut site, or the cut site alone (zero length)
+    with --no_offsets. Cut sites are drawn on a coarse grid so many sit
+    exactly on window edges.
+    """
+    chrom = np.random.randint(3, size=n)
+    cut   = 1000 + 25 * np.random.randint(0, 4*n, size=n)
+    if no_offsets:
+        return np.stack([chrom, cut, cut], axis=1)
+    plus  = np.random.uniform(size=n) < 0.5
+    return np.stack([chrom, np.where(plus, cut - 152, cut - 146), np.where(plus, cut + 147, cut + 153)], axis=1)
+
+def main(args):
+    np.random.seed(args.random_seed)
+    n_checks = 0
+    for trial in range(args.trials):
+        n = np.random.randint(1, args.max_guides + 1)
+        window_size = int(np.random.choice([50, 100, 200]))
+        step_size   = int(np.random.choice([s for s in [25, 50, 100] if s <= window_size]))
+        for no_offsets in [False, True]:
+            pos_array = random_guides(n, no_offsets)
+            expect = scan_windows(pos_array, window_size, step_size)
+            result = get_sliding_windows(pos_array, window_size, step_size)
+            assert expect.shape == result.shape and (expect == result).all(), \
+                   "get_sliding_windows(no_offsets={}) differs on {}".format(no_offsets, pos_array.tolist())
+            if expect.shape[0] == 0:
+                continue
+            for a, b in zip(scan_overlaps(pos_array, expect), get_window_overlaps(pos_array, expect)):
+                assert a.shape == b.shape and (a == b).all(), \
+                       "get_window_overlaps(no_offsets={}) differs on {}".format(no_offsets, pos_array.tolist())
+            n_checks += 1
+    print("{} checks over {} random guide sets passed.".format(n_checks, args.trials), file=sys.stderr)
+    return n_checks
+
+if __name__ == "__main__":
+    args = get_args()
+    check_args(args)
+    main(args)
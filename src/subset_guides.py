@@ -1,10 +1,15 @@
 import numpy as np
 import pandas as pd
+import os
+import sys
 import argparse
 import math
 import csv
 from collections import OrderedDict
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'casa'))
+from genome_utils import get_sliding_windows, get_window_overlaps, parse_guide_coords
+
 def get_args():    
     parser = argparse.ArgumentParser(description='Call peaks over CRISPRi screen windows.')
     parser.add_argument('guide_data',help='Input flow-fish guide count data.')
@@ -29,14 +34,6 @@ def check_args(args):
     assert args.window_size > 0, "Windows must take up space."
     return True
 
-def check_overlap_bed(interval, array):
-    height = array.shape[0]
-    intervals = np.stack([np.tile(interval,(height,1)), array],axis=0)
-    swaghook = (intervals[0,:,1] < intervals[1,:,1]).astype(int)
-    chrom    = (intervals[0,:,0] == intervals[0,:,0])
-    overlap  = intervals[1-swaghook,np.arange(height),2] > intervals[swaghook,np.arange(height),1]
-    return overlap & chrom
-
 def main(args):
     #####################
     ##   Import data   ##
@@ -67,48 +64,32 @@ def main(args):
             spec_list.append( np.nan )
     guide_data['cutting_specificity_score'] = spec_list
     guide_data = guide_data.fillna( 0.0 )
-    ## Split targeting and control guides
-    targ_data  = guide_data.loc[ guide_data['Coordinates'].str.contains('chr') ]
-    ctrl_data  = guide_data.loc[~guide_data['Coordinates'].str.contains('chr') ]
     ## Parse targeting coordinates
     plus_offsets = [152, 147]
     minus_offsets= [146, 153]
-    uniq_chrom= np.unique([coord.split(':')[0] for coord in targ_data['Coordinates']])
+    guides     = parse_guide_coords(guide_data['Coordinates'], plus_offsets, minus_offsets)
+    ## Split targeting and control guides
+    is_targ    = guides['chrom'].notnull().values
+    targ_data  = guide_data.loc[ is_targ ]
+    ctrl_data  = guide_data.loc[~is_targ ]
+    targ_chrom = guides.loc[ is_targ, 'chrom' ].cat.remove_unused_categories()
+    uniq_chrom= targ_chrom.cat.categories.values.astype(str)
     chrom2idx = OrderedDict( [ (x,i) for i,x in enumerate(uniq_chrom) ] )
     idx2chrom = OrderedDict( [ (i,x) for i,x in enumerate(uniq_chrom) ] )
     ## Get targeting positions for each guide
-    pos_array = np.array([ ( chrom2idx[coord.split(':')[0]],
-                             int(coord.split(':')[1].split('-')[1]) - plus_offsets[0],
-                             int(coord.split(':')[1].split('-')[1]) + plus_offsets[1] ) if coord.split(':')[2] == '+' 
-                           else ( chrom2idx[coord.split(':')[0]],
-                                  int(coord.split(':')[1].split('-')[1]) - minus_offsets[0],
-                                  int(coord.split(':')[1].split('-')[1]) + minus_offsets[1] )
-                           for coord in targ_data['Coordinates'] ])
+    pos_array = np.stack([ targ_chrom.cat.codes.values.astype(np.int64), 
+                           guides.loc[ is_targ, 'target_start' ].values.astype(np.int64), 
+                           guides.loc[ is_targ, 'target_end' ].values.astype(np.int64) ], axis=1)
     ## Get genomic windows covered on each chrom
-    genome_lims = OrderedDict(
-        [ (idx, 
-           (pos_array[pos_array[:,0] == idx, 1].min(),
-            pos_array[pos_array[:,0] == idx, 2].max())
-          ) for idx, chrom in idx2chrom.items() ] 
-    )
-    sliding_window = [ (idx, np.vstack( (np.arange(*lims,args.step_size),
-                                        np.minimum(np.arange(*lims,args.step_size)+args.window_size,lims[1])) ).T 
-                       )
-                       for idx, lims in genome_lims.items() ]
-    sliding_window = np.concatenate(
-        [ np.concatenate( (np.tile( [[idx]], (a_window.shape[0],1) ), a_window), axis=1 ) 
-          for idx, a_window in sliding_window ]
-    )
-    sliding_window = sliding_window[[ np.any(check_overlap_bed(interval,pos_array)) 
-                                      for interval in sliding_window ]]
-    ## Get chromosome
-    chrom = targ_data['Coordinates'].iloc[0].split(':')[0]
+    sliding_window = get_sliding_windows(pos_array, args.window_size, args.step_size)
+    pair_wnd, pair_guide = get_window_overlaps(pos_array, sliding_window)
+    wnd_bounds = np.searchsorted(pair_wnd, np.arange(sliding_window.shape[0]+1))
     ## Work through windows and do subset
     guide_filter = []
-    for a_window in sliding_window:
-        guide_capture = check_overlap_bed(a_window,pos_array)
-        current_slice = targ_data.loc[guide_capture]
-        capture_count = guide_capture.sum()
+    for i in range(sliding_window.shape[0]):
+        guide_capture = pair_guide[ wnd_bounds[i]:wnd_bounds[i+1] ]
+        current_slice = targ_data.iloc[guide_capture]
+        capture_count = guide_capture.shape[0]
         removal_count = math.floor(capture_count*args.subset_frac)
         removal_count = max(0, removal_count - current_slice['Coordinates'].isin(guide_filter).sum())
         current_slice = current_slice.iloc[~current_slice['Coordinates'].isin(guide_filter).values ]
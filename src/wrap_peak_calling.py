@@ -17,6 +17,7 @@ def get_args():
     parser.add_argument('--job_count','-j',type=int,default=1,help='Number of jobs to split analysis over.')
     parser.add_argument('--compute_zones','-z',type=str,default='us-*',help='Zones for VMs. Remember, costs very between zones.')
     parser.add_argument('--preemptable','-p',action='store_true',help='Flag to use preemptable VMs.')
+    parser.add_argument('--journal_sync','-js',type=int,default=300,help='Seconds between uploads of each task\'s results journal to GS.')
     args = parser.parse_args()
     return args
 
@@ -35,14 +36,16 @@ def main(args):
         ##                       ##
         ###########################
         with open(task_fn,'w') as t_fh:
-            print('--env CHUNK\t--input INFILE\t--output OUTFILE',file=t_fh)
+            print('--env CHUNK\t--input INFILE\t--output OUTFILE\t--env JOURNAL\t--output TELEMETRY',file=t_fh)
             input_base = os.path.basename(args.input_data)
             input_link = os.path.join(gs_loc,input_base)
             output_base= os.path.basename(args.output_tag)
             output_link= os.path.join(gs_loc,output_base) + \
                          '__{}_' + '{}.bed'.format(args.job_count)
             for i in range(args.job_count):
-                cmd_args = [str(i),input_link,output_link.format(i)]
+                cmd_args = [str(i),input_link,output_link.format(i),
+                            output_link.format(i)+'.journal',
+                            output_link.format(i)+'.telemetry.jsonl']
                 print('\t'.join(cmd_args),file=t_fh)
         #####################
         ##                 ##
@@ -57,11 +60,17 @@ def main(args):
         ## build dsub submission command ##
         ##                               ##
         ###################################
-        vm_cmd = "python /app/casa/call_peaks.py ${INFILE} ${OUTFILE} " +\
+        ## Results journal is pulled from GS on (re)start and pushed back 
+        ## periodically, so a retried task only re-runs unfinished windows
+        vm_cmd = "gsutil -q cp ${JOURNAL} journal.tsv || true; " +\
+                 "( while sleep {}; do gsutil -q cp journal.tsv ${{JOURNAL}}; done ) & ".format(args.journal_sync) +\
+                 "python /app/casa/call_peaks.py ${INFILE} ${OUTFILE} " +\
                  "-ji ${CHUNK} " + "-jr {} ".format(args.job_count) +\
-                 "-ws {} -ss {}".format(args.window_size, args.step_size)
+                 "-ws {} -ss {}".format(args.window_size, args.step_size) +\
+                 " --journal journal.tsv --resume --telemetry ${TELEMETRY}"
         if args.no_offsets:
             vm_cmd += " --no_offsets"
+        vm_cmd += "; status=$?; kill $!; exit $status"
         format_list = [args.billed_project, args.compute_zones, 
                        os.path.join(gs_loc,'logs'), task_fn, vm_cmd]
         dsub_cmd = "dsub --provider google-v2 --project {} --zones {} " +\
@@ -99,6 +108,15 @@ def main(args):
                     for i in range(args.job_count) ] + \
                   ['>',args.output_tag+'.bed']
         write_out = subprocess.run(" ".join(cat_cmd),shell=True)
+        ## Chunk telemetry records carry their job index
+        gs_cmd = 'gsutil cp {} {}/'.format(output_link.format('*')+'.telemetry.jsonl',tmpdirname)
+        gs_get = subprocess.run(gs_cmd.split())
+        cat_cmd = ['cat'] + \
+                  [ os.path.join( tmpdirname, 
+                                    os.path.basename(output_link.format(i))+'.telemetry.jsonl' )
+                    for i in range(args.job_count) ] + \
+                  ['>',args.output_tag+'.telemetry.jsonl']
+        write_out = subprocess.run(" ".join(cat_cmd),shell=True)
         ########################
         ##                    ##
         ## Clean up GS bucket ##